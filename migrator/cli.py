@@ -8,8 +8,11 @@ import sys
 import tabulate
 import os
 
-from migrator.config import Config
+from migrator.config import Config, TargetError
+from migrator.container import COMPRESSION_GZIP, get_compressions
 from migrator.executor import Executor
+from migrator.fanout import FanOut, TargetResult
+from migrator.planner import PlanError
 
 # Установка локализации
 from migrator.fixtures import FixtureLoader
@@ -43,7 +46,7 @@ def get_one_revision(migrator, rev):
     if not revisions:
         halt(_(u'Revision {} not found.').format(rev))
     if len(revisions) > 1:
-        halt(_(u'Revision {} has too much matches ({}).').format(rev, len(revisions)))
+        halt(_(u'Revision {} has too much matches ({}).').format(rev, u', '.join(x['hash'] for x in revisions)))
     return revisions[0]
 
 
@@ -61,6 +64,7 @@ def cli(ctx, config):
         cfg.make_default()
         ctx.obj['config_path'] = None
     ctx.obj.update({'cfg': cfg})
+    ctx.call_on_close(cfg.close_db)
 
 
 @cli.command()
@@ -163,16 +167,47 @@ def create_config(
     click.echo(_(u'Config successfully saved!'))
 
 
+def enable_copy(cfg):
+    cfg.setdefault(cfg.BASE_SECTION, {})[cfg.MIGRATOR_FIXTURE_COPY] = 'yes'
+
+
+def split_model_options(values):
+    options = {}
+    for value in values:
+        if ':' not in value:
+            halt(_(u'Expected model:value, got {}').format(value))
+        model_name, option = value.split(':', 1)
+        options[model_name.strip()] = option.strip()
+    return options
+
+
+def split_sample_options(values):
+    samples = split_model_options(values)
+    for model_name, percent in samples.items():
+        try:
+            samples[model_name] = float(percent)
+        except ValueError:
+            samples[model_name] = None
+        if samples[model_name] is None or not 0 < samples[model_name] <= 100:
+            halt(_(u'Sample percent must be in (0, 100], got {}').format(percent))
+    return samples
+
+
 @cli.command('make')
 @click.option('--type', 'migration_type', default='from_db',
               type=click.Choice(['from_db', 'from_last', 'from_rev', 'empty', 'data']))
 @click.option('--rev', default=None)
 @click.option('--name', default=None)
 @click.option('--models', default=None)
+@click.option('--format', 'dump_format', default='jsonl', type=click.Choice(['jsonl', 'copy']))
+@click.option('--compression', default=COMPRESSION_GZIP, type=click.Choice(get_compressions()))
+@click.option('--incremental', default=False, is_flag=True)
+@click.option('--filter', 'filters', multiple=True, help='model:SQL condition')
+@click.option('--sample', 'samples', multiple=True, help='model:percent')
 @click.pass_context
-def make_migration(ctx, migration_type, rev, name, models):
+def make_migration(ctx, migration_type, rev, name, models, dump_format, compression, incremental, filters, samples):
     migrator = Executor(ctx.obj['cfg'])
-    if rev is None and migration_type == 'rev':
+    if rev is None and migration_type == 'from_rev':
         halt(_(u'--rev param required'))
     migration_name = (click.prompt(_(u'Migration title')) or None) if name is None else name
 
@@ -186,15 +221,13 @@ def make_migration(ctx, migration_type, rev, name, models):
             halt(_(u'There are no latest migration.'))
         migrator.migrate_from_migration(migration=last[0], migration_name=migration_name)
     elif migration_type == 'from_rev':
-        revisions = migrator.get_migrations_by_hash(rev)
-        if not revisions:
-            click.echo(_(u'Revision {} not found.').format(rev))
-        if len(revisions) > 1:
-            halt(_(u'Revision {} has too much matches ({}).').format(rev, len(revisions)))
-        migrator.migrate_from_migration(migration=revisions[0], migration_name=migration_name)
+        migrator.migrate_from_migration(migration=get_one_revision(migrator, rev), migration_name=migration_name)
     elif migration_type == 'data':
-        loader = FixtureLoader(ctx.obj['cfg'])
-        loader.make_data_migration(migration_name=migration_name, only_models=models)
+        loader = FixtureLoader(ctx.obj['cfg'], compression=compression)
+        loader.make_data_migration(
+            migration_name=migration_name, only_models=models, dump_format=dump_format, incremental=incremental,
+            filters=split_model_options(filters), samples=split_sample_options(samples)
+        )
     else:
         print('Unknown migration type {}'.format(migration_type))
 
@@ -202,9 +235,13 @@ def make_migration(ctx, migration_type, rev, name, models):
 @cli.command('apply')
 @click.option('--force', default=False, is_flag=True)
 @click.option('--fake', default=False, is_flag=True)
+@click.option('--transaction', default=None, type=click.Choice(Executor.TRANSACTION_MODES))
+@click.option('--copy', default=False, is_flag=True, help='load PostgreSQL fixtures with COPY')
 @click.argument('rev')
 @click.pass_context
-def apply_migration(ctx, force, fake, rev):
+def apply_migration(ctx, force, fake, transaction, copy, rev):
+    if copy:
+        enable_copy(ctx.obj['cfg'])
     migrator = Executor(ctx.obj['cfg'])
     revision = get_one_revision(migrator, rev)
     if migrator.check_status(revision['hash']) == migrator.STATUS_APPLIED:
@@ -213,22 +250,23 @@ def apply_migration(ctx, force, fake, rev):
     if not migrator.check_dependencies(revision):
         not_applied = [x for x in revision['dependencies'] if migrator.check_status(x) != migrator.STATUS_APPLIED]
         halt(_(u'Migration dependencies not applied: {}').format(u','.join(not_applied)))
-    migrator.apply(revision, fake=fake)
+    migrator.apply(revision, fake=fake, transaction=transaction)
     click.echo(_(u'Migration {} applied successfully!').format(revision['hash']))
 
 
 @cli.command('revert')
 @click.option('--force', default=False, is_flag=True)
 @click.option('--fake', default=False, is_flag=True)
+@click.option('--transaction', default=None, type=click.Choice(Executor.TRANSACTION_MODES))
 @click.argument('rev')
 @click.pass_context
-def revert_migration(ctx, force, fake, rev):
+def revert_migration(ctx, force, fake, transaction, rev):
     migrator = Executor(ctx.obj['cfg'])
     revision = get_one_revision(migrator, rev)
     if migrator.check_status(revision['hash']) != migrator.STATUS_APPLIED:
         if not force and not click.confirm(_(u'Migration not applied. Revert?'), default=False):
             halt(_(u'Abort'))
-    migrator.revert(revision, fake=fake)
+    migrator.revert(revision, fake=fake, transaction=transaction)
     click.echo(_(u'Migration {} reverted successfully!').format(revision['hash']))
 
 
@@ -271,23 +309,80 @@ def mark_required(ctx, after, rev):
 
 @cli.command('up')
 @click.option('--fake', default=False, is_flag=True)
+@click.option('--transaction', default=None, type=click.Choice(Executor.TRANSACTION_MODES))
+@click.option('--all-targets', default=False, is_flag=True)
+@click.option('--workers', default=4, type=int)
+@click.option('--keep-going', default=False, is_flag=True)
+@click.option('--copy', default=False, is_flag=True, help='load PostgreSQL fixtures with COPY')
 @click.pass_context
-def up_required(ctx, fake):
+def up_required(ctx, fake, transaction, all_targets, workers, keep_going, copy):
+    if copy:
+        enable_copy(ctx.obj['cfg'])
+    if all_targets:
+        return up_targets(ctx.obj['cfg'], fake, transaction, workers, keep_going)
     migrator = Executor(ctx.obj['cfg'])
     required = migrator.get_required()
     if not required:
         halt(_(u'There are no required migrations (Empty required.json)'))
 
-    to_apply = [rev for rev in required if migrator.check_status(rev) != migrator.STATUS_APPLIED]
+    try:
+        plan = migrator.plan(required)
+    except PlanError as e:
+        halt(e)
+    if not plan:
+        halt(_(u'Project already up to date'))
+    migrator.apply_plan(
+        plan, fake=fake, transaction=transaction,
+        callback=lambda revision: click.echo(_(u'Migration {} applied successfully!').format(revision['hash']))
+    )
+
+
+def up_targets(cfg, fake, transaction, workers, keep_going):
+    try:
+        fan_out = FanOut(cfg, workers=workers, stop_on_failure=not keep_going)
+    except TargetError as e:
+        halt(e)
+    if not fan_out.executor.load_required():
+        halt(_(u'There are no required migrations (Empty required.json)'))
+    try:
+        results = fan_out.apply(
+            fake=fake, transaction=transaction,
+            callback=lambda result: click.echo(u'{}: {}'.format(result.name, result.status))
+        )
+    except (PlanError, TargetError) as e:
+        halt(e)
+    headers = [_(u'Target'), _(u'Status'), _(u'Applied'), _(u'Error')]
+    rows = [[x.name, x.status, len(x.applied), x.error or u''] for x in results]
+    click.echo(tabulate.tabulate(rows, headers, tablefmt='psql'))
+    if any(x.status != TargetResult.STATUS_OK for x in results):
+        sys.exit(1)
+
+
+@cli.command('adopt')
+@click.argument('revs', nargs=-1)
+@click.pass_context
+def adopt_migrations(ctx, revs):
+    migrator = Executor(ctx.obj['cfg'])
+    migrations = [get_one_revision(migrator, rev) for rev in revs] if revs else list(migrator.get_migrations())
+    to_apply = [x for x in migrations if x['status'] != migrator.STATUS_APPLIED]
     if not to_apply:
         halt(_(u'Project already up to date'))
-    for rev in to_apply:
-        revision = get_one_revision(migrator, rev)
-        if not migrator.check_dependencies(revision):
-            not_applied = [x for x in revision['dependencies'] if migrator.check_status(x) != migrator.STATUS_APPLIED]
-            halt(_(u'Migration dependencies not applied: {}').format(u','.join(not_applied)))
-        migrator.apply(revision, fake=fake)
-        click.echo(_(u'Migration {} applied successfully!').format(revision['hash']))
+    migrator.fake_apply_many(to_apply)
+    click.echo(_(u'{} migrations marked as applied').format(len(to_apply)))
+
+
+@cli.command('gc')
+@click.option('--dry-run', default=False, is_flag=True)
+@click.pass_context
+def gc_fixtures(ctx, dry_run):
+    loader = FixtureLoader(ctx.obj['cfg'])
+    removed = loader.gc(dry_run=dry_run)
+    for path in removed:
+        click.echo(path)
+    if dry_run:
+        click.echo(_(u'{} fixture files to remove').format(len(removed)))
+    else:
+        click.echo(_(u'{} fixture files removed').format(len(removed)))
 
 
 if __name__ == '__main__':
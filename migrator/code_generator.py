@@ -42,6 +42,10 @@ def down(config):
 {down}
 '''
 
+    # Параметры полей, которые сохраняются в снимке схемы миграции (см. models_json)
+    SNAPSHOT_PARAMS = ('index', 'unique', 'null', 'default')
+    SNAPSHOT_KWARGS = ('db_field', 'to_field', 'rel_model')
+
     def __init__(self, models):
         self.models = models
 
@@ -159,10 +163,29 @@ def down(config):
                 fields_json.append(field_json)
             model_json.update({'table': db_table, 'fields': fields_json})
             if imports:
-                model_json['imports'] = list(imports)
+                model_json['imports'] = sorted(imports)
             models_json.append(model_json)
         return sorted(models_json, key=lambda x: x['name'])
 
+    def models_json(self):
+        """
+        Модели в виде, пригодном для JSON: только то, что нужно clses_code и clses_json
+        """
+        models_json = []
+        for model, db_table, fields in self.models:
+            fields_json = []
+            for field in fields:
+                params = {key: field['params'][key] for key in self.SNAPSHOT_PARAMS if key in field['params']}
+                initial_kwargs = field['params'].get('initial_kwargs', {})
+                initial_kwargs = {key: initial_kwargs[key] for key in self.SNAPSHOT_KWARGS if key in initial_kwargs}
+                if initial_kwargs:
+                    params['initial_kwargs'] = initial_kwargs
+                fields_json.append({
+                    'name': field['name'], 'column': field['column'], 'path': field['path'], 'params': params
+                })
+            models_json.append([model, db_table, fields_json])
+        return models_json
+
     @classmethod
     def changes_code(cls, migration, indent=0):
         builder = cls.Builder(indent=indent)
@@ -237,13 +260,17 @@ def down(config):
         result_code = [builder.code]
         return result_code
 
+    @staticmethod
+    def default_migration_name(migration_hash):
+        return 'Миграция {}'.format(migration_hash)
+
     @classmethod
     def migration_code(
             cls, imports, models, up=None, down=None, migration_name=None,
             proxies=None, dependencies=None, migration_time=None, migration_hash=None
     ):
         if migration_name is None:
-            migration_name = 'Миграция {}'.format(migration_hash)
+            migration_name = cls.default_migration_name(migration_hash)
         if dependencies is None:
             migration_dependencies = []
         else:
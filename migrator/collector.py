@@ -7,15 +7,15 @@ __all__ = ['ChangesCollector']
 class ChangesCollector(object):
     @classmethod
     def get_table_matches(cls, new, old):
+        """
+        Соответствие моделей: по имени, иначе по таблице (из нескольких старых моделей таблицы - последняя)
+        """
+        old_by_table = {}
+        for o_name, o_model in old.items():
+            old_by_table[o_model['table']] = o_name
         matches = {}
         for name, model in new.items():
-            match = None
-            if name in old:
-                match = name
-            else:
-                for o_name, o_model in old.items():
-                    if o_model['table'] == model['table']:
-                        match = o_name
+            match = name if name in old else old_by_table.get(model['table'])
             if match is not None:
                 matches[name] = match
         return matches
@@ -45,16 +45,16 @@ class ChangesCollector(object):
 
     @classmethod
     def get_field_matches(cls, new_ordered, new_fields, old_fields):
+        """
+        Соответствие полей: совпадение по db_field (из нескольких старых полей - последнее) важнее совпадения по имени
+        """
+        old_by_db_field = {}
+        for o_field_name, o_field in old_fields.items():
+            old_by_db_field[cls.get_db_field(o_field)] = o_field_name
         field_matches = {}
         for field in new_ordered:
-            match = None
-            if field['name'] in old_fields:
-                match = field['name']
-            # else:
-            if True:
-                for o_field_name, o_field in old_fields.items():
-                    if cls.get_db_field(field) == cls.get_db_field(o_field):
-                        match = o_field_name
+            match = field['name'] if field['name'] in old_fields else None
+            match = old_by_db_field.get(cls.get_db_field(field), match)
             if match is not None:
                 field_matches[field['name']] = match
         return field_matches
@@ -6,7 +6,11 @@ from playhouse.db_url import connect
 from playhouse.migrate import SqliteMigrator, MySQLMigrator, PostgresqlMigrator
 from six.moves import configparser
 
-__all__ = ['Config']
+__all__ = ['Config', 'TargetError']
+
+
+class TargetError(Exception):
+    pass
 
 
 class Config(dict):
@@ -19,14 +23,41 @@ class Config(dict):
     MIGRATOR_MODELS_PATH = 'models_path'
     MIGRATOR_EXCLUDED_MODELS = 'excluded_models'
 
+    # Хранение списка примененных миграций: fs - файл .applied.json, db - таблица в базе данных
+    MIGRATOR_STATE_BACKEND = 'state_backend'
+    MIGRATOR_STATE_TABLE = 'state_table'
+    # Транзакции при применении миграций: none, migration, batch
+    MIGRATOR_TRANSACTION = 'transaction'
+    # Список баз для применения миграций на нескольких базах: url или имена секций с параметром db_url
+    MIGRATOR_TARGETS = 'targets'
+    # Количество потоков загрузки фикстур (для sqlite всегда 1)
+    MIGRATOR_FIXTURE_WORKERS = 'fixture_workers'
+    # Поля отметок инкрементальной выгрузки данных через запятую: model:field (по умолчанию - первичный ключ)
+    MIGRATOR_FIXTURE_WATERMARKS = 'fixture_watermarks'
+    # Быстрая загрузка фикстур: индексы перестраиваются после загрузки, запись без синхронизации (yes/no)
+    MIGRATOR_FIXTURE_FAST_LOAD = 'fixture_fast_load'
+    # Значения фикстур через pickle (yes/no): только для доверенных фикстур, распаковка выполняет произвольный код
+    MIGRATOR_FIXTURE_ALLOW_PICKLE = 'fixture_allow_pickle'
+    # Загрузка фикстур в PostgreSQL через COPY ... FROM STDIN (yes/no)
+    MIGRATOR_FIXTURE_COPY = 'fixture_copy'
+
     MIGRATORS = {
         'sqlite': SqliteMigrator,
         'mysql': MySQLMigrator,
         'postgres': PostgresqlMigrator
     }
 
+    # Ограничение на количество параметров в одном запросе
+    MAX_QUERY_PARAMS = {
+        'sqlite': 999,
+        'mysql': 65535,
+        'postgres': 32767
+    }
+
     def __init__(self, *args, **kwargs):
         self.cp = configparser.ConfigParser()
+        # Один объект базы данных на url, общий для migrator, фикстур и всех модулей миграций
+        self._databases = {}
         super(Config, self).__init__(*args, **kwargs)
 
     def make_default(self):
@@ -74,7 +105,15 @@ class Config(dict):
         url = self.get(self.BASE_SECTION, {}).get(self.MIGRATOR_DB_URL, None)
         if url is None:
             return None
-        return connect(url)
+        db = self._databases.get(url)
+        if db is None:
+            db = self._databases[url] = connect(url)
+        return db
+
+    def close_db(self):
+        for db in self._databases.values():
+            if not db.is_closed():
+                db.close()
 
     def get_migrator(self):
         migrator = self.MIGRATORS.get(self.db_type, lambda x: None)(self.get_db())
@@ -88,9 +127,16 @@ class Config(dict):
         if db_url:
             return db_url.split(':')[0]
 
+    @property
+    def max_query_params(self):
+        return self.MAX_QUERY_PARAMS.get(self.db_type, 999)
+
     def get_setting(self, key, default=None):
         return self.get(self.BASE_SECTION, {}).get(key, default)
 
+    def get_flag(self, key):
+        return (self.get_setting(key) or '').strip().lower() in ('1', 'yes', 'true', 'on')
+
     def _get_list_by_comma(self, value):
         return [x.strip() for x in value.split(',')]
 
@@ -98,4 +144,34 @@ class Config(dict):
         return self._get_list_by_comma(self.get_setting(self.MIGRATOR_EXCLUDED_MODELS, ''))
 
     def get_models_paths(self):
-        return self._get_list_by_comma(self.get_setting(self.MIGRATOR_MODELS_PATH))
\ No newline at end of file
+        return self._get_list_by_comma(self.get_setting(self.MIGRATOR_MODELS_PATH))
+
+    def get_targets(self):
+        targets = []
+        for target in self._get_list_by_comma(self.get_setting(self.MIGRATOR_TARGETS, '')):
+            if not target:
+                continue
+            if '://' in target:
+                targets.append((target, target))
+                continue
+            url = self.get(target, {}).get(self.MIGRATOR_DB_URL)
+            if url is None:
+                raise TargetError('No {} in config section {}'.format(self.MIGRATOR_DB_URL, target))
+            targets.append((target, url))
+        return targets
+
+    def get_fixture_watermarks(self):
+        watermarks = {}
+        for item in self._get_list_by_comma(self.get_setting(self.MIGRATOR_FIXTURE_WATERMARKS, '')):
+            if not item:
+                continue
+            if ':' not in item:
+                raise Exception('Bad {} item {}, expected model:field'.format(self.MIGRATOR_FIXTURE_WATERMARKS, item))
+            model_name, field_name = item.split(':', 1)
+            watermarks[model_name.strip()] = field_name.strip()
+        return watermarks
+
+    def for_target(self, db_url):
+        config = Config({section: dict(variables) for section, variables in self.items()})
+        config[self.BASE_SECTION][self.MIGRATOR_DB_URL] = db_url
+        return config
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Файлы данных фикстуры по частям (chunk): не больше chunk_rows строк в файле, сжатие gzip или lzma.
+Части хранятся по содержимому (sha256 несжатых строк) в общем для всех миграций данных хранилище,
+manifest.json фикстуры ссылается на них по хешу.
+"""
+
+from __future__ import unicode_literals
+
+import codecs
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+import uuid
+
+import six
+
+try:
+    import lzma
+except ImportError:
+    # python 2
+    lzma = None
+
+__all__ = [
+    'COMPRESSION_NONE', 'COMPRESSION_GZIP', 'COMPRESSION_LZMA', 'get_compressions', 'ChunkStore', 'ChunkWriter'
+]
+
+COMPRESSION_NONE = 'none'
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_LZMA = 'lzma'
+
+EXTENSIONS = {
+    COMPRESSION_NONE: '',
+    COMPRESSION_GZIP: '.gz',
+    COMPRESSION_LZMA: '.xz',
+}
+
+
+def get_compressions():
+    return [COMPRESSION_NONE, COMPRESSION_GZIP] + ([COMPRESSION_LZMA] if lzma is not None else [])
+
+
+def _compressed(fileobj, compression, mode):
+    if compression == COMPRESSION_GZIP:
+        # mtime=0: одинаковые данные дают одинаковый файл
+        return gzip.GzipFile(filename='', mode=mode, fileobj=fileobj, mtime=0)
+    if compression == COMPRESSION_LZMA:
+        if lzma is None:
+            raise Exception('lzma compression is not available')
+        return lzma.LZMAFile(fileobj, mode)
+    if compression == COMPRESSION_NONE:
+        return fileobj
+    raise Exception('Unknown compression {}'.format(compression))
+
+
+class ChunkWriter(object):
+    """
+    Файлоподобный объект для записи строк (JSON lines или COPY) частями по chunk_rows строк в хранилище store.
+    Границы частей зависят только от строк, поэтому неизменная таблица дает те же части, что и в прошлый раз.
+    """
+
+    def __init__(self, store, extension, compression=COMPRESSION_GZIP, chunk_rows=100000):
+        self.store = store
+        self.extension = '{}{}'.format(extension, EXTENSIONS[compression])
+        self.compression = compression
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.rows = 0
+        self._raw = self._file = self._sha256 = None
+        self._chunk_rows = 0
+
+    def _open_chunk(self):
+        self._temp_path = self.store.get_temp_path()
+        self._raw = io.open(self._temp_path, 'wb')
+        self._file = _compressed(self._raw, self.compression, 'wb')
+        self._sha256 = hashlib.sha256()
+        self._chunk_rows = 0
+
+    def _close_chunk(self):
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+        sha256 = self._sha256.hexdigest()
+        self.store.add(self._temp_path, sha256, self.extension)
+        self.chunks.append({'sha256': sha256, 'rows': self._chunk_rows})
+        self.rows += self._chunk_rows
+        self._raw = self._file = self._sha256 = None
+
+    def _write(self, data):
+        self._sha256.update(data)
+        self._file.write(data)
+
+    def write(self, data):
+        if isinstance(data, six.text_type):
+            data = data.encode('utf-8')
+        while data:
+            if self._file is None:
+                self._open_chunk()
+            free = self.chunk_rows - self._chunk_rows
+            if data.count(b'\n') < free:
+                self._write(data)
+                self._chunk_rows += data.count(b'\n')
+                break
+            # Часть заполнена: дописываем строки до границы и открываем следующую
+            end = -1
+            for _ in range(free):
+                end = data.index(b'\n', end + 1)
+            self._write(data[:end + 1])
+            self._chunk_rows += free
+            self._close_chunk()
+            data = data[end + 1:]
+
+    def close(self):
+        """
+        Описание записанных частей для manifest.json
+        """
+        if self._file is not None:
+            self._close_chunk()
+        return self.chunks
+
+
+class ChunkStore(object):
+    """
+    Хранилище частей по содержимому: <path>/<sha256[:2]>/<sha256>.<extension>.
+    Проверенные части запоминаются в .verified.json по размеру и времени изменения файла,
+    повторная загрузка их не перепроверяет.
+    """
+    VERIFIED_FILE = '.verified.json'
+    TEMP_PREFIX = '.tmp-'
+    # Временные файлы старше этого возраста (секунды) остались от прерванной записи и удаляются при сборке мусора
+    TEMP_GRACE = 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        self._verified = None
+        self._lock = threading.Lock()
+
+    def get_path(self, sha256, extension):
+        return os.path.join(self.path, sha256[:2], '{}.{}'.format(sha256, extension))
+
+    def get_temp_path(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        return os.path.join(self.path, '{}{}'.format(self.TEMP_PREFIX, uuid.uuid4().hex))
+
+    def add(self, temp_path, sha256, extension):
+        """
+        Перенос записанной части в хранилище. Если такая часть уже есть, новый файл удаляется.
+        """
+        path = self.get_path(sha256, extension)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return False
+        with self._lock:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if os.path.exists(path):
+                os.remove(temp_path)
+                return False
+            os.rename(temp_path, path)
+        return True
+
+    def _file_key(self, path):
+        stat = os.stat(path)
+        return [stat.st_size, int(stat.st_mtime)]
+
+    @property
+    def verified(self):
+        if self._verified is None:
+            try:
+                with codecs.open(os.path.join(self.path, self.VERIFIED_FILE), 'r', 'utf-8') as f:
+                    self._verified = json.loads(f.read())
+            except (IOError, OSError, ValueError):
+                self._verified = {}
+        return self._verified
+
+    def save_verified(self):
+        if self._verified is None or not os.path.exists(self.path):
+            return
+        with self._lock:
+            with codecs.open(os.path.join(self.path, self.VERIFIED_FILE), 'w', 'utf-8') as f:
+                f.write(json.dumps(self._verified, sort_keys=True))
+
+    def read_lines(self, sha256, extension, compression):
+        """
+        Строки части. При первом чтении хеш содержимого проверяется до выдачи строк отдельным проходом по файлу.
+        """
+        path = self.get_path(sha256, extension)
+        key = self._file_key(path)
+        if self.verified.get(sha256) != key:
+            digest = hashlib.sha256()
+            for line in self._read_raw_lines(path, compression):
+                digest.update(line)
+            if digest.hexdigest() != sha256:
+                raise Exception('Checksum mismatch in fixture chunk {}'.format(path))
+            with self._lock:
+                self.verified[sha256] = key
+        for line in self._read_raw_lines(path, compression):
+            yield line.decode('utf-8')
+
+    def _read_raw_lines(self, path, compression):
+        with io.open(path, 'rb') as raw:
+            f = _compressed(raw, compression, 'rb')
+            try:
+                for line in iter(f.readline, b''):
+                    yield line
+            finally:
+                if f is not raw:
+                    f.close()
+
+    def iter_files(self):
+        """
+        Пары (sha256, путь) всех частей хранилища
+        """
+        if not os.path.isdir(self.path):
+            return
+        for directory in sorted(os.listdir(self.path)):
+            directory_path = os.path.join(self.path, directory)
+            if directory.startswith('.') or not os.path.isdir(directory_path):
+                continue
+            for file_name in sorted(os.listdir(directory_path)):
+                yield file_name.split('.', 1)[0], os.path.join(directory_path, file_name)
+
+    def iter_stale_temp_files(self):
+        """
+        Временные файлы прерванной записи, старше TEMP_GRACE (более новые может писать другой процесс)
+        """
+        if not os.path.isdir(self.path):
+            return
+        deadline = time.time() - self.TEMP_GRACE
+        for file_name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, file_name)
+            if file_name.startswith(self.TEMP_PREFIX) and os.path.getmtime(path) < deadline:
+                yield path
+
+    def gc(self, referenced, dry_run=False):
+        """
+        Удаление частей, на которые не ссылается ни одна фикстура, и временных файлов прерванной записи.
+        Результат - пути удаленных файлов.
+        """
+        removed = []
+        for path in self.iter_stale_temp_files():
+            removed.append(path)
+            if not dry_run:
+                os.remove(path)
+        for sha256, path in self.iter_files():
+            if sha256 in referenced:
+                continue
+            removed.append(path)
+            if not dry_run:
+                os.remove(path)
+                self.verified.pop(sha256, None)
+        if not dry_run:
+            self.save_verified()
+        return removed
+
@@ -3,13 +3,16 @@
 from __future__ import unicode_literals
 
 import inspect
+import os
 
 import six
 import sys
 from inspect import getmodule, ismethod, isclass
+from types import FunctionType
 
 from peewee import BaseModel, ForeignKeyField
-from playhouse.reflection import Introspector
+
+from migrator.reflection import SchemaReflector
 
 if sys.version_info > (3,):
     if sys.version_info > (3, 4):
@@ -17,7 +20,102 @@ if sys.version_info > (3,):
     else:
         from imp import reload
 
-__all__ = ['Inspector']
+__all__ = ['Inspector', 'FieldDescriptor', 'FieldParams']
+
+# Отметки (время изменения, размер) файлов загруженных модулей моделей и результаты разбора моделей,
+# общие для всех Inspector процесса: неизмененные модули не перезагружаются и не разбираются повторно
+_module_stamps = {}
+_inspected = {}
+
+
+def _source_path(path):
+    if path and path.endswith(('.pyc', '.pyo')) and os.path.exists(path[:-1]):
+        return path[:-1]
+    return path
+
+
+def _file_stamp(module):
+    path = _source_path(getattr(module, '__file__', None))
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    return stat.st_mtime, stat.st_size
+
+
+def _package_modules(path):
+    """
+    Загруженный модуль path и его подмодули (для пакета моделей)
+    """
+    prefix = '{}.'.format(path)
+    return sorted(
+        (name, module) for name, module in list(sys.modules.items())
+        if module is not None and (name == path or name.startswith(prefix))
+    )
+
+
+class _SlotsMapping(object):
+    """
+    Компактный объект с __slots__, доступный и как словарь: незаданный атрибут - отсутствующий ключ
+    """
+    __slots__ = ()
+    __hash__ = None
+
+    def __init__(self, **kwargs):
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def keys(self):
+        return [key for key in self.__slots__ if hasattr(self, key)]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self.__slots__ and hasattr(self, key)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not hasattr(other, 'items'):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return '{}({})'.format(self.__class__.__name__, dict(self.items()))
+
+
+class FieldParams(_SlotsMapping):
+    __slots__ = ('index', 'unique', 'null', 'default', 'initial_kwargs')
+
+
+class FieldDescriptor(_SlotsMapping):
+    """
+    Описание поля модели: name, column, path (класс поля) и params (FieldParams)
+    """
+    __slots__ = ('name', 'column', 'path', 'params')
 
 
 class Inspector(object):
@@ -33,31 +131,78 @@ class Inspector(object):
         if models_path is not None:
             self.models_path = models_path
         self.excluded_models = [] if excluded_models is None else excluded_models
+        # Планы сбора атрибутов по классам полей, см. get_field_plan
+        self._field_plans = {}
 
     @staticmethod
     def is_model(obj):
         return isclass(obj) and (issubclass(obj, BaseModel) or isinstance(obj, BaseModel))
 
+    @staticmethod
+    def get_module_stamps(path):
+        return tuple((name, _file_stamp(module)) for name, module in _package_modules(path))
+
+    def load_module(self, path):
+        """
+        Импорт модуля моделей. Уже импортированный модуль перезагружается, только если изменились файлы его
+        или его подмодулей (сначала подмодули, затем пакет); модуль, импортированный не через Inspector,
+        перезагружается один раз.
+        """
+        module = sys.modules.get(path)
+        if module is None:
+            module = __import__(path, fromlist=['*'])
+        else:
+            changed = [
+                name for name, stamp in self.get_module_stamps(path)
+                if name not in _module_stamps or _module_stamps[name] != stamp
+            ]
+            for name in sorted(changed, reverse=True):
+                reload(sys.modules[name])
+            module = sys.modules[path]
+        _module_stamps.update(self.get_module_stamps(path))
+        return module
+
+    def iter_module_models(self, module):
+        for model in dir(module):
+            if model[0].isupper() and model[0] != '_':
+                obj = getattr(module, model)
+                if self.is_model(obj) and model not in self.excluded_models:
+                    yield model, obj
+
     def get_models(self):
         for path in self.models_path:
-            module = __import__(path, fromlist=['*'])
-            models = reload(module)
-            for model in dir(models):
-                if model[0].isupper() and model[0] != '_':
-                    obj = getattr(models, model)
-                    if self.is_model(obj) and model not in self.excluded_models:
-                        yield model, obj
+            for model, obj in self.iter_module_models(self.load_module(path)):
+                yield model, obj
 
-    def get_database_models(self, db=None):
-        i = Introspector.from_database(db)
-        return i.generate_models().values()
+    def get_database_models(self, db=None, table_names=None, cache_path=None, excluded_tables=()):
+        """
+        Модели таблиц базы данных: всех или table_names (вместе с таблицами, на которые они ссылаются),
+        кроме excluded_tables
+        """
+        reflector = SchemaReflector(db, cache_path=cache_path)
+        models = reflector.generate_models(table_names=table_names)
+        return [model for table, model in models.items() if table not in excluded_tables]
 
     def inspect_models(self):
-        for model, model_obj in self.get_models():
-            yield self.inspect_model(model_obj, model=model)
+        """
+        Описания моделей из models_path. Для модуля, файлы которого не менялись, берется прежний результат.
+        """
+        for path in self.models_path:
+            module = self.load_module(path)
+            key = (path, tuple(sorted(self.excluded_models)))
+            stamps = self.get_module_stamps(path)
+            cached = _inspected.get(key)
+            if cached is None or cached[0] != stamps:
+                cached = _inspected[key] = stamps, [
+                    self.inspect_model(model_obj, model=model) for model, model_obj in self.iter_module_models(module)
+                ]
+            for inspected in cached[1]:
+                yield inspected
 
-    def inspect_database(self, db):
-        models = self.get_database_models(db)
+    def inspect_database(self, db, table_names=None, cache_path=None, excluded_tables=()):
+        models = self.get_database_models(
+            db, table_names=table_names, cache_path=cache_path, excluded_tables=excluded_tables
+        )
         for model_obj in models:
             yield self.inspect_model(model_obj)
 
@@ -86,14 +231,35 @@ class Inspector(object):
         # TODO: Надо научиться как-то отлавливать такие builtins, как datetime.datetime.now, у которых module None
         return None
 
+    def get_field_plan(self, field):
+        """
+        Путь к классу поля и атрибуты класса, которые попадают в initial_kwargs: (имя, свойство ли это).
+        Вычисляется один раз для класса поля, атрибуты экземпляра (field.__dict__) добавляются для каждого поля.
+        """
+        field_class = field.__class__
+        plan = self._field_plans.get(field_class)
+        if plan is not None:
+            return plan
+        field_path = field_class.__name__
+        field_module = getmodule(field_class)
+        if field_module is not None:
+            field_path = '{}.{}'.format(field_module.__name__, field_path)
+        attributes = []
+        for param in dir(field_class):
+            if param[0] == '_' or param in self.EXCLUDED_FIELDS:
+                continue
+            class_attribute = next(klass.__dict__[param] for klass in field_class.__mro__ if param in klass.__dict__)
+            if isinstance(class_attribute, (FunctionType, classmethod)):
+                # Методы класса - методы для всех его полей
+                continue
+            # Свойства и другие дескрипторы читаются с перехватом ошибок
+            attributes.append((param, hasattr(type(class_attribute), '__get__')))
+        plan = self._field_plans[field_class] = (field_path, attributes)
+        return plan
+
     def collect_fields(self, sorted_fields, model=''):
         for field in sorted_fields:
-            name = field.name
-            field_path = field.__class__.__name__
-            field_module = getmodule(field.__class__)
-            if field_module is not None:
-                field_module = field_module.__name__
-                field_path = '{}.{}'.format(field_module, field_path)
+            field_path, attributes = self.get_field_plan(field)
 
             default_value = self.get_field_default(field.default)
             field_params = {
@@ -103,19 +269,22 @@ class Inspector(object):
             if default_value is not None:
                 field_params['default'] = default_value
 
-            for param in dir(field):
-                if param[0] == '_' or param in field_params or param in self.EXCLUDED_FIELDS:
+            initial_kwargs = field_params['initial_kwargs']
+            for param, is_property in attributes:
+                if param in field_params or param in field.__dict__:
                     continue
-                try:
+                if is_property:
+                    try:
+                        param_obj = getattr(field, param)
+                    except Exception:
+                        param_obj = None
+                else:
                     param_obj = getattr(field, param)
-                except:
-                    param_obj = None
-                if ismethod(param_obj) or (param_obj is None and param in self.NOT_INCLUDE_IF_NULL):
-                    continue
-                if param_obj is False and param in self.NOT_INCLUDE_IF_FALSE:
+                self._add_param(initial_kwargs, param, param_obj)
+            for param, param_obj in field.__dict__.items():
+                if param[0] == '_' or param in field_params or param in self.EXCLUDED_FIELDS or ismethod(param_obj):
                     continue
-
-                field_params['initial_kwargs'][param] = param_obj
+                self._add_param(initial_kwargs, param, param_obj)
             # if field.name != field.db_column:
             #     field_params['initial_kwargs']['db_field'] = field.db_column
 
@@ -123,22 +292,31 @@ class Inspector(object):
 
             if isinstance(field, ForeignKeyField):
                 # Сохраняем только название модели
-                field_params['initial_kwargs']['rel_model'] = field.rel_model.__name__
+                initial_kwargs['rel_model'] = field.rel_model.__name__
                 # Нормализация обращения к полю
                 db_column = field.name if field.db_column == '{}_id'.format(field.name) else field.db_column
                 to_field = {
                     'name': field.to_field.name, 'column': field.to_field.db_column
                 }
                 if to_field['name'] == 'id' and to_field['column'] == 'id':
-                    field_params['initial_kwargs'].pop('to_field', None)
+                    initial_kwargs.pop('to_field', None)
                 else:
-                    field_params['initial_kwargs']['to_field'] = to_field
+                    initial_kwargs['to_field'] = to_field
                     # Убираем умолчательное значение related_name
                     # model_set = u'{}_set'.format(re.sub('[^\w]+', '_', model.lower()))
                     # if field_params['initial_kwargs']['related_name'] == model_set:
                     #     del field_params['initial_kwargs']['related_name']
 
-            if not field_params['initial_kwargs']:
+            if not initial_kwargs:
                 field_params.pop('initial_kwargs', None)
 
-            yield {'name': name, 'column': db_column, 'path': field_path, 'params': field_params}
+            yield FieldDescriptor(
+                name=field.name, column=db_column, path=field_path, params=FieldParams(**field_params)
+            )
+
+    def _add_param(self, initial_kwargs, param, param_obj):
+        if param_obj is None and param in self.NOT_INCLUDE_IF_NULL:
+            return
+        if param_obj is False and param in self.NOT_INCLUDE_IF_FALSE:
+            return
+        initial_kwargs[param] = param_obj
@@ -3,7 +3,9 @@
 from __future__ import unicode_literals
 
 import codecs
+import contextlib
 import hashlib
+import importlib
 import json
 import os
 import sys
@@ -12,10 +14,23 @@ import time
 from migrator.code_generator import CodeGenerator
 from migrator.collector import ChangesCollector
 from migrator.db_inspector import Inspector
+from migrator.manifest import Manifest, read_header
+from migrator.planner import Planner
+from migrator.state import FileStateBackend, DatabaseStateBackend
 
 __all__ = ['Executor']
 
 
+def import_fresh(name):
+    """
+    Импорт модуля, файл которого мог быть только что записан: кеш содержимого директорий sys.path
+    (python 3) не видит файлы, созданные вскоре после его заполнения
+    """
+    if hasattr(importlib, 'invalidate_caches'):
+        importlib.invalidate_caches()
+    return __import__(name)
+
+
 def extend_path(path, index=0):
     for p in reversed(path.split(':')):
         if p not in sys.path:
@@ -27,12 +42,29 @@ class Executor(object):
     STATUS_APPLIED = 'applied'
     STATUS_AVAILABLE = 'available'
     REQUIRED_FILE = 'required.json'
+    # Кеш описания таблиц базы данных для make --type from_db
+    REFLECTION_CACHE_FILE = '.reflection.json'
+    # Снимок схемы после миграции для make --type from_last/from_rev
+    SCHEMA_SNAPSHOT_FILE = 'migration_{}.json'
+    # Транзакции при применении: none - без транзакции, migration - каждая миграция вместе с отметкой
+    # о применении, batch - весь план одной транзакцией. Миграция может отказаться: MIGRATION_ATOMIC = False
+    TRANSACTION_NONE = 'none'
+    TRANSACTION_MIGRATION = 'migration'
+    TRANSACTION_BATCH = 'batch'
+    TRANSACTION_MODES = (TRANSACTION_NONE, TRANSACTION_MIGRATION, TRANSACTION_BATCH)
+    STATE_BACKENDS = {
+        'fs': FileStateBackend,
+        'db': DatabaseStateBackend
+    }
 
     def __init__(self, config):
         self.config = config
         # Необходимо для корректной работы
         extend_path(config.get_setting(config.MIGRATOR_SYS_PATH), 1)
         self.migrations_in_path = False
+        self._manifest = None
+        self._state = None
+        self._snapshot = None
 
     def _extend_migrations(self):
         if not self.migrations_in_path:
@@ -40,60 +72,193 @@ class Executor(object):
             self.migrations_in_path = True
 
     def import_migration(self, migration):
-        return __import__(migration['import'])
+        self._extend_migrations()
+        return import_fresh(migration['import'])
 
-    def get_migrations(self):
-        migrations_dir = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
-        # Необходимо для работы __import__
+    @property
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = Manifest(
+                self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), header_loader=self.load_header
+            )
+        return self._manifest
+
+    @property
+    def state(self):
+        if self._state is None:
+            backend = self.config.get_setting(self.config.MIGRATOR_STATE_BACKEND) or 'fs'
+            if backend not in self.STATE_BACKENDS:
+                raise Exception('Unknown state backend {}'.format(backend))
+            self._state = self.STATE_BACKENDS[backend](self.config)
+        return self._state
+
+    def load_header(self, revision, path):
+        header = read_header(path)
+        if header is not None:
+            return header
+        # Написанная вручную миграция, заголовок можно получить только импортом
         self._extend_migrations()
+        migration = import_fresh('migration_{}'.format(revision))
+        return {
+            'name': migration.MIGRATION_NAME,
+            'time': migration.MIGRATION_TIME,
+            'dependencies': migration.MIGRATION_DEPENDENCIES,
+        }
 
-        for f in os.listdir(migrations_dir):
-            if f.startswith('migration_') and f.endswith('.py'):
-                revision = f.split('migration_', 1)[-1].rsplit('.py', 1)[0]
-                yield self.fetch_migration(revision)
+    def get_migrations(self):
+        for revision in self.manifest.entries():
+            yield self.fetch_migration(revision)
 
     def get_migrations_by_hash(self, base_hash, migrations=None):
-        migrations = self.get_migrations() if migrations is None else migrations
-        return [x for x in migrations if x['hash'].startswith(base_hash)]
+        if migrations is not None:
+            return [x for x in migrations if x['hash'].startswith(base_hash)]
+        return [self.fetch_migration(revision) for revision in self.manifest.find(base_hash)]
 
     def fetch_migration(self, revision):
-        self._extend_migrations()
-        migration = __import__('migration_{}'.format(revision))
+        entry = self.manifest.get(revision)
+        if entry is None:
+            raise Exception('Migration {} not found'.format(revision))
         return {
-            'time': migration.MIGRATION_TIME,
-            'name': migration.MIGRATION_NAME,
+            'time': entry['time'],
+            'name': entry['name'],
             'hash': revision,
             'file': 'migration_{}.py'.format(revision),
             'import': 'migration_{}'.format(revision),
-            'dependencies': migration.MIGRATION_DEPENDENCIES,
+            'dependencies': entry['dependencies'],
             # Примененность
             'status': self.check_status(revision),
             # Обязательность
             'required': self.check_required_position(revision)
         }
 
-    def apply(self, migration, fake=False):
-        if not fake:
-            _module = self.import_migration(migration)
-            _module.up(config=self.config)
-        self.make_applied(migration['hash'])
+    def get_transaction_mode(self, transaction=None):
+        mode = transaction or self.config.get_setting(self.config.MIGRATOR_TRANSACTION) or self.TRANSACTION_NONE
+        if mode not in self.TRANSACTION_MODES:
+            raise Exception('Unknown transaction mode {}'.format(mode))
+        return mode
+
+    @staticmethod
+    def is_atomic(module):
+        return module is None or getattr(module, 'MIGRATION_ATOMIC', True)
+
+    @contextlib.contextmanager
+    def transaction(self, atomic=True):
+        if atomic:
+            with self.get_db_obj().atomic():
+                yield
+        else:
+            yield
+
+    def run_migration(self, module, action):
+        if module is None:
+            return None
+        started = time.time()
+        getattr(module, action)(config=self.config)
+        return time.time() - started
+
+    def apply(self, migration, fake=False, transaction=None):
+        _module = None if fake else self.import_migration(migration)
+        atomic = self.get_transaction_mode(transaction) != self.TRANSACTION_NONE and self.is_atomic(_module)
+        with self.transaction(atomic):
+            duration = self.run_migration(_module, 'up')
+            if self.state.transactional:
+                self.make_applied(migration['hash'], duration=duration)
+        if not self.state.transactional:
+            self.make_applied(migration['hash'], duration=duration)
+
+    def fake_apply_many(self, migrations):
+        """
+        Пометка миграций примененными без выполнения, например, при подключении существующей базы
+        """
+        self.state.add_many([(x['hash'], self.get_checksum(x['hash'])) for x in migrations])
+        self.invalidate_snapshot()
+
+    def get_planner(self):
+        return Planner(self.manifest.entries().values())
+
+    def plan(self, targets=None, applied=None):
+        """
+        Список миграций для применения в порядке зависимостей.
+        По умолчанию целями являются обязательные миграции, а примененные берутся из текущего состояния.
+        """
+        targets = self.get_required() if targets is None else targets
+        applied = self.get_snapshot()['applied'] if applied is None else applied
+        return [self.fetch_migration(x['hash']) for x in self.get_planner().plan(targets, applied)]
+
+    def apply_plan(self, plan, fake=False, callback=None, transaction=None):
+        mode = self.get_transaction_mode(transaction)
+        if mode != self.TRANSACTION_BATCH:
+            for migration in plan:
+                self.apply(migration, fake=fake, transaction=mode)
+                if callback is not None:
+                    callback(migration)
+            return
+        batch = []
+        for migration in plan:
+            _module = None if fake else self.import_migration(migration)
+            if self.is_atomic(_module):
+                batch.append((migration, _module))
+                continue
+            # Миграция без транзакции разбивает план: предыдущие фиксируются до ее выполнения
+            self.apply_batch(batch, callback=callback)
+            batch = []
+            self.apply(migration, fake=fake, transaction=self.TRANSACTION_NONE)
+            if callback is not None:
+                callback(migration)
+        self.apply_batch(batch, callback=callback)
+
+    def apply_batch(self, batch, callback=None):
+        if not batch:
+            return
+        applied = []
+        with self.transaction():
+            for migration, _module in batch:
+                duration = self.run_migration(_module, 'up')
+                applied.append((migration, duration))
+                if self.state.transactional:
+                    self.make_applied(migration['hash'], duration=duration)
+        for migration, duration in applied:
+            if not self.state.transactional:
+                self.make_applied(migration['hash'], duration=duration)
+            if callback is not None:
+                callback(migration)
+
+    def revert(self, migration, fake=False, transaction=None):
+        _module = None if fake else self.import_migration(migration)
+        atomic = self.get_transaction_mode(transaction) != self.TRANSACTION_NONE and self.is_atomic(_module)
+        with self.transaction(atomic):
+            self.run_migration(_module, 'down')
+            if self.state.transactional:
+                self.unmake_applied(migration['hash'])
+        if not self.state.transactional:
+            self.unmake_applied(migration['hash'])
+
+    def get_snapshot(self):
+        """
+        Состояние проекта (примененные и обязательные миграции), читается один раз до первой записи
+        """
+        if self._snapshot is None:
+            required = self.load_required()
+            required_positions = {}
+            for position, revision in enumerate(required):
+                required_positions.setdefault(revision, position)
+            self._snapshot = {
+                'applied': set(self.state.get_applied()),
+                'required': required,
+                'required_positions': required_positions,
+            }
+        return self._snapshot
 
-    def revert(self, migration, fake=False):
-        if not fake:
-            _module = self.import_migration(migration)
-            _module.down(self.config)
-        self.unmake_applied(migration['hash'])
+    def invalidate_snapshot(self):
+        self._snapshot = None
 
     def get_applied(self):
-        migrations_dir = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
-        # TODO: Добавить бэкенд сохранения в БД
-        try:
-            with codecs.open(os.path.join(migrations_dir, '.applied.json'), 'r', 'utf-8') as f:
-                return json.loads(f.read())
-        except:
-            return []
+        return list(self.get_snapshot()['applied'])
 
     def get_required(self):
+        return list(self.get_snapshot()['required'])
+
+    def load_required(self):
         migrations_dir = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
         try:
             with codecs.open(os.path.join(migrations_dir, self.REQUIRED_FILE), 'r', 'utf-8') as f:
@@ -111,22 +276,19 @@ class Executor(object):
                 pass
         required.insert(position, revision)
         self.save_required_fs(required)
+        self.invalidate_snapshot()
 
-    def make_applied(self, revision):
-        applied = set(self.get_applied())
-        applied.add(revision)
-        self.save_applied_fs(applied)
+    def get_checksum(self, revision):
+        entry = self.manifest.get(revision)
+        return entry['checksum'] if entry is not None else None
 
-    def unmake_applied(self, revision):
-        applied = set(self.get_applied())
-        applied.remove(revision)
-        self.save_applied_fs(applied)
+    def make_applied(self, revision, duration=None):
+        self.state.add(revision, duration=duration, checksum=self.get_checksum(revision))
+        self.invalidate_snapshot()
 
-    def save_applied_fs(self, applied):
-        # TODO: Добавить бэкенд сохранения в БД
-        migrations_dir = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
-        with codecs.open(os.path.join(migrations_dir, '.applied.json'), 'w', 'utf-8') as f:
-            f.write(json.dumps(list(applied)))
+    def unmake_applied(self, revision):
+        self.state.remove(revision)
+        self.invalidate_snapshot()
 
     def save_required_fs(self, required):
         migrations_dir = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
@@ -134,20 +296,16 @@ class Executor(object):
             f.write(json.dumps(required))
 
     def check_status(self, revision):
-        applied = self.get_applied()
+        applied = self.get_snapshot()['applied']
 
         return self.STATUS_APPLIED if revision in applied else self.STATUS_AVAILABLE
 
     def check_required_position(self, revision):
-        required = self.get_required()
-
-        try:
-            return required.index(revision)
-        except ValueError:
-            return None
+        return self.get_snapshot()['required_positions'].get(revision)
 
     def check_dependencies(self, migration):
-        return all([self.check_status(dep) == self.STATUS_APPLIED for dep in migration['dependencies']])
+        applied = self.get_snapshot()['applied']
+        return all(dep in applied for dep in migration['dependencies'])
 
     def get_db_obj(self):
         return self.config.get_db()
@@ -164,24 +322,33 @@ class Executor(object):
         current_models = list(i.inspect_models())
         c = CodeGenerator(current_models)
         imports, models, proxies = c.clses_code()
-        new = {x['name']: x for x in c.clses_json()}
-        return self.migrate(imports, models, proxies, new, new, migration_name=migration_name)
+        snapshot = self.make_schema_snapshot(c)
+        new = {x['name']: x for x in snapshot['schema']}
+        return self.migrate(imports, models, proxies, new, new, migration_name=migration_name, snapshot=snapshot)
 
     def migrate_from_migration(self, migration=None, migration_name=None):
         excluded_models = self.config.get_excluded()
-        # Получение информации о предыдущем состоянии из моделй
-        i = Inspector(models_path=[migration['import']], excluded_models=excluded_models)
-        old_models = list(i.inspect_models())
-        old = {x['name']: x for x in CodeGenerator(old_models).clses_json()}
+        # Получение информации о предыдущем состоянии: из снимка схемы миграции или из ее моделей
+        previous = self.read_schema_snapshot(migration['hash'])
+        if previous is not None:
+            old_models = previous['models']
+            old = {x['name']: x for x in previous['schema']}
+        else:
+            self._extend_migrations()
+            i = Inspector(models_path=[migration['import']], excluded_models=excluded_models)
+            old_models = list(i.inspect_models())
+            old = {x['name']: x for x in CodeGenerator(old_models).clses_json()}
         # Получение информации о текущем состоянии из моделей
         i = Inspector(models_path=self.config.get_models_paths(), excluded_models=excluded_models)
         current_models = list(i.inspect_models())
-        new = {x['name']: x for x in CodeGenerator(current_models).clses_json()}
+        snapshot = self.make_schema_snapshot(CodeGenerator(current_models))
+        new = {x['name']: x for x in snapshot['schema']}
         # генерация кода старых и новых моделей
         c = CodeGenerator(current_models + old_models)
         imports, models, proxies = c.clses_code()
         return self.migrate(
-            imports, models, proxies, new, old, migration_name=migration_name, dependencies=[migration]
+            imports, models, proxies, new, old, migration_name=migration_name, dependencies=[migration],
+            snapshot=snapshot
         )
 
     def migrate_from_db(self, migration_name=None):
@@ -189,38 +356,46 @@ class Executor(object):
         i = Inspector(models_path=self.config.get_models_paths(), excluded_models=excluded_models)
         # Получение информации о текущем состоянии из моделей
         current_models = list(i.inspect_models())
-        new = {x['name']: x for x in CodeGenerator(current_models).clses_json()}
-        # Получение информации о состоянии из базы данных
-        db_models = list(i.inspect_database(self.get_db_obj()))
+        snapshot = self.make_schema_snapshot(CodeGenerator(current_models))
+        new = {x['name']: x for x in snapshot['schema']}
+        # Получение информации о состоянии из базы данных: только таблицы моделей и те, на которые они ссылаются
+        current_models_tables = [m[1] for m in current_models]
+        cache_path = os.path.join(
+            self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), self.REFLECTION_CACHE_FILE
+        )
+        db_models = list(i.inspect_database(
+            self.get_db_obj(), table_names=current_models_tables, cache_path=cache_path,
+            excluded_tables=self.state.tables
+        ))
         old = {x['name']: x for x in CodeGenerator(db_models).clses_json()}
         # генерация кода старых и новых моделей
-        current_models_tables = [m[1] for m in current_models]
         for db_model in db_models:
             if db_model[1] not in current_models_tables:
                 current_models.append(db_model)
         c = CodeGenerator(current_models)
         imports, models, proxies = c.clses_code()
-        return self.migrate(imports, models, proxies, new, old, migration_name=migration_name)
+        return self.migrate(imports, models, proxies, new, old, migration_name=migration_name, snapshot=snapshot)
 
-    def migrate(self, imports, models, proxies, new, old, migration_name=None, dependencies=None):
+    def migrate(self, imports, models, proxies, new, old, migration_name=None, dependencies=None, snapshot=None):
         up_migration = self._get_migration_changes(new=new, old=old)
         up = self.CodeGenerator.changes_code(up_migration, indent=4)
         down_migration = self._get_migration_changes(new=old, old=new)
         down = self.CodeGenerator.changes_code(down_migration, indent=4)
         return self.make_migration(
             imports, models, up=up, down=down, migration_name=migration_name, proxies=proxies,
-            dependencies=dependencies
+            dependencies=dependencies, snapshot=snapshot
         )
 
     def _get_migration_changes(self, new, old):
         collector = ChangesCollector()
         # Построение таблицы соответствий
         model_matches = collector.get_table_matches(new, old)
+        matched_old = set(model_matches.values())
         # Операции миграции
         migration = {
             # Базовые операции: создание и удаление таблиц
-            'drop': [x for x in old.keys() if x not in model_matches.values()],
-            'create': [x for x in new.keys() if x not in model_matches.keys()],
+            'drop': [x for x in old.keys() if x not in matched_old],
+            'create': [x for x in new.keys() if x not in model_matches],
             # Наполняемые данные
             'rename': [],
             'fields': {
@@ -265,17 +440,56 @@ class Executor(object):
 
         return migration
 
+    def get_schema_snapshot_path(self, revision):
+        return os.path.join(
+            self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), self.SCHEMA_SNAPSHOT_FILE.format(revision)
+        )
+
+    @staticmethod
+    def make_schema_snapshot(code_generator):
+        """
+        Снимок схемы: модели для генерации кода (models_json) и нормализованное описание для сравнения (clses_json)
+        """
+        return {'models': code_generator.models_json(), 'schema': code_generator.clses_json()}
+
+    def write_schema_snapshot(self, revision, snapshot):
+        try:
+            data = json.dumps(snapshot, sort_keys=True)
+        except (TypeError, ValueError):
+            # Значения по умолчанию, не представимые в JSON: состояние будет прочитано из модуля миграции
+            return
+        with codecs.open(self.get_schema_snapshot_path(revision), 'w', 'utf-8') as f:
+            f.write(data)
+
+    def read_schema_snapshot(self, revision):
+        """
+        Снимок схемы после миграции или None для миграций, созданных без снимка
+        """
+        try:
+            with codecs.open(self.get_schema_snapshot_path(revision), 'r', 'utf-8') as f:
+                return json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return None
+
     def make_migration(
-        self, imports, models, up=None, down=None, migration_name=None, proxies=None, dependencies=None
+        self, imports, models, up=None, down=None, migration_name=None, proxies=None, dependencies=None,
+        migration_time=None, snapshot=None
     ):
+        """
+        snapshot - снимок схемы после миграции (make_schema_snapshot), сохраняется рядом с файлом миграции
+        """
 
         self.check_migrations_package()
 
-        migration_time = int(time.time())
+        if migration_time is None:
+            migration_time = int(time.time())
         migration_hash = hashlib.md5(str(migration_time).encode('utf-8')).hexdigest()
+        if migration_name is None:
+            migration_name = self.CodeGenerator.default_migration_name(migration_hash)
 
         migration_kwargs = locals()
         migration_kwargs.pop('self', None)
+        migration_kwargs.pop('snapshot', None)
 
         migration_path = os.path.join(
             self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR),
@@ -285,6 +499,12 @@ class Executor(object):
 
         with codecs.open(migration_path, 'w', 'utf-8') as f:
             f.write(migration_code)
+        if snapshot is not None:
+            self.write_schema_snapshot(migration_hash, snapshot)
+        self.manifest.add(
+            migration_hash, name=migration_name, time=migration_time,
+            dependencies=[x['hash'] for x in (dependencies or [])]
+        )
 
         return migration_path
 
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import multiprocessing
+
+from migrator.config import Config, TargetError
+from migrator.executor import Executor
+
+__all__ = ['FanOut', 'TargetResult']
+
+# Флаг остановки, общий для процессов пула (задается в _init_worker)
+_stop = None
+
+
+class TargetResult(object):
+    STATUS_OK = 'ok'
+    STATUS_FAILED = 'failed'
+    STATUS_SKIPPED = 'skipped'
+
+    def __init__(self, name, db_url, status, applied=None, error=None):
+        self.name = name
+        self.db_url = db_url
+        self.status = status
+        self.applied = applied or []
+        self.error = error
+
+
+def _init_worker(stop):
+    global _stop
+    _stop = stop
+
+
+def _apply_target(task):
+    index, name, db_url, settings, plan, fake, transaction, stop_on_failure = task
+    return index, _apply_plan(name, db_url, settings, plan, fake, transaction, stop_on_failure)
+
+
+def _apply_plan(name, db_url, settings, plan, fake, transaction, stop_on_failure):
+    if _stop is not None and _stop.is_set():
+        return TargetResult(name, db_url, TargetResult.STATUS_SKIPPED)
+    config = Config(settings)
+    executor = Executor(config)
+    applied = []
+    try:
+        done = executor.get_snapshot()['applied']
+        executor.apply_plan(
+            [executor.fetch_migration(revision) for revision in plan if revision not in done],
+            fake=fake, transaction=transaction, callback=lambda migration: applied.append(migration['hash'])
+        )
+    except Exception as e:
+        if stop_on_failure and _stop is not None:
+            _stop.set()
+        return TargetResult(name, db_url, TargetResult.STATUS_FAILED, applied=applied, error=repr(e))
+    finally:
+        config.close_db()
+    return TargetResult(name, db_url, TargetResult.STATUS_OK, applied=applied)
+
+
+class FanOut(object):
+    """
+    Применение одного плана миграций к нескольким базам (config.get_targets()) пулом процессов.
+    Модули миграций держат базу в глобальном proxy_db, поэтому базы обрабатываются в разных процессах.
+    """
+
+    def __init__(self, config, targets=None, workers=4, stop_on_failure=True):
+        self.config = config
+        self.targets = config.get_targets() if targets is None else targets
+        self.workers = max(1, min(workers, len(self.targets) or 1))
+        self.stop_on_failure = stop_on_failure
+        self.executor = Executor(config)
+
+    def check(self):
+        backend = self.config.get_setting(self.config.MIGRATOR_STATE_BACKEND) or 'fs'
+        if backend != 'db':
+            raise TargetError('Applying to several databases requires {} = db'.format(
+                self.config.MIGRATOR_STATE_BACKEND
+            ))
+        if not self.targets:
+            raise TargetError('No targets in config ({})'.format(self.config.MIGRATOR_TARGETS))
+
+    def plan(self, revisions=None):
+        """
+        Общий порядок применения для всех баз. Каждая база пропускает уже примененные у нее миграции.
+        """
+        revisions = self.executor.load_required() if revisions is None else revisions
+        return [x['hash'] for x in self.executor.get_planner().plan(revisions, applied=())]
+
+    def apply(self, revisions=None, fake=False, transaction=None, callback=None):
+        self.check()
+        plan = self.plan(revisions)
+        tasks = [
+            (index, name, db_url, dict(self.config.for_target(db_url)), plan, fake, transaction, self.stop_on_failure)
+            for index, (name, db_url) in enumerate(self.targets)
+        ]
+        stop = multiprocessing.Event()
+        pool = multiprocessing.Pool(self.workers, initializer=_init_worker, initargs=(stop,))
+        results = {}
+        try:
+            for index, result in pool.imap_unordered(_apply_target, tasks):
+                results[index] = result
+                if callback is not None:
+                    callback(result)
+        finally:
+            pool.close()
+            pool.join()
+        return [results[index] for index in range(len(tasks))]
@@ -2,53 +2,193 @@
 import codecs
 import hashlib
 import json
+import logging
 import os
+import shutil
+import sys
 import time
+from multiprocessing.pool import ThreadPool
 
 import peewee
-from playhouse.shortcuts import model_to_dict, dict_to_model
+import six
+from playhouse.shortcuts import dict_to_model
 
 from migrator.code_generator import CodeGenerator
+from migrator.container import COMPRESSION_GZIP, EXTENSIONS, ChunkStore, ChunkWriter
 from migrator.db_inspector import Inspector
 from migrator.executor import Executor
-from migrator.utils import SafeEncoder, pickle_hook
+from migrator.pg_copy import CopyStream, decode_line, decode_value, encode_row
+from migrator.utils import PickleFallbackEncoder, RowCodec, TaggedEncoder, pickle_tagged_hook, tagged_hook
+
+logger = logging.getLogger(__name__)
+
+
+class FixtureTable(object):
+    """
+    Данные одной модели в фикстуре: части в хранилище store с описанием из manifest.json,
+    или список строк старого формата
+    """
+    FORMAT_JSONL = 'jsonl'
+    FORMAT_COPY = 'copy'
+    # Значения строк jsonl закодированы RowCodec и TaggedEncoder
+    CODEC_TAGGED = 'tagged'
+
+    def __init__(self, meta=None, rows=None, store=None, object_hook=tagged_hook):
+        self.meta = meta or {}
+        self.rows = rows
+        self.store = store
+        self.object_hook = object_hook
+
+    @property
+    def format(self):
+        return self.meta.get('format', self.FORMAT_JSONL)
+
+    def __bool__(self):
+        return bool(self.rows) if self.rows is not None else bool(self.meta.get('rows'))
+
+    __nonzero__ = __bool__
+
+    def iter_lines(self):
+        compression = self.meta['compression']
+        extension = '{}{}'.format(self.format, EXTENSIONS[compression])
+        for chunk in self.meta['chunks']:
+            for line in self.store.read_lines(chunk['sha256'], extension, compression):
+                yield line
+
+    def iter_rows(self, model_class):
+        if self.rows is not None:
+            for row in self.rows:
+                yield row
+        elif self.format == self.FORMAT_COPY:
+            fields = [model_class._meta.fields[name] for name in self.meta['columns']]
+            for line in self.iter_lines():
+                yield {
+                    field.name: decode_value(field, value) for field, value in zip(fields, decode_line(line))
+                }
+        elif self.meta.get('codec') == self.CODEC_TAGGED:
+            codec = RowCodec(model_class)
+            for line in self.iter_lines():
+                if line.strip():
+                    yield codec.decode(json.loads(line, object_hook=self.object_hook))
+        else:
+            for line in self.iter_lines():
+                if line.strip():
+                    yield json.loads(line, object_hook=self.object_hook)
 
 
 class FixtureLoader(object):
-    #  Pycharm stub
-    _table = None
-    _with_schema = None
+    """
+    Фикстура миграции данных - директория fixtures/<migration_hash>/ с файлом manifest.json и
+    построчным JSON (одна строка таблицы на строку файла) для каждой модели. Данные модели записываются
+    частями по chunk_rows строк в общее хранилище fixtures/chunks/, manifest.json ссылается на части
+    по sha256 содержимого. Неизменные таблицы дают те же части и не занимают места повторно.
+    """
+    FIXTURES_DIR = 'fixtures'
+    CHUNKS_DIR = 'chunks'
+    MANIFEST_FILE = 'manifest.json'
+    # Количество строк, выбираемых из базы одним запросом
+    CHUNK_SIZE = 10000
+    # Количество строк в одном файле данных
+    CHUNK_ROWS = 100000
+    # Количество потоков загрузки, если в конфиге не задан fixture_workers
+    WORKERS = 4
 
-    def __init__(self, config):
+    def __init__(self, config, chunk_size=None, use_copy=None, allow_pickle=None, workers=None,
+                 compression=COMPRESSION_GZIP, chunk_rows=None, fast_load=None):
         self.config = config
         self.executor = Executor(config=config)
         self.db = self.config.get_db()
+        self.chunk_size = chunk_size or self.CHUNK_SIZE
+        self.compression = compression
+        self.chunk_rows = chunk_rows or self.CHUNK_ROWS
+        self.store = ChunkStore(os.path.join(self.get_fixtures_dir(), self.CHUNKS_DIR))
+        # Загрузка в PostgreSQL через COPY ... FROM STDIN (по умолчанию - вставка запросами)
+        if use_copy is None:
+            use_copy = self.config.get_flag(self.config.MIGRATOR_FIXTURE_COPY)
+        self.use_copy = use_copy
+        # Сериализация через pickle значений, для которых нет тега, и распаковка pickle при загрузке
+        # (по умолчанию - ошибка выгрузки и загрузки)
+        if allow_pickle is None:
+            allow_pickle = self.config.get_flag(self.config.MIGRATOR_FIXTURE_ALLOW_PICKLE)
+        self.encoder = PickleFallbackEncoder if allow_pickle else TaggedEncoder
+        self.object_hook = pickle_tagged_hook if allow_pickle else tagged_hook
+        if workers is None:
+            workers = int(self.config.get_setting(self.config.MIGRATOR_FIXTURE_WORKERS) or self.WORKERS)
+        # SQLite допускает только одного пишущего
+        self.workers = 1 if self.config.db_type == 'sqlite' else max(1, workers)
+        # Удаление неуникальных индексов на время загрузки и настройки сессии для быстрой записи
+        if fast_load is None:
+            fast_load = self.config.get_flag(self.config.MIGRATOR_FIXTURE_FAST_LOAD)
+        self.fast_load = fast_load
+
+    def get_fixtures_dir(self):
+        return os.path.join(self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), self.FIXTURES_DIR)
 
-    def make_data_migration(self, migration_name, only_models=None):
+    def get_fixture_path(self, migration_hash):
+        return os.path.join(self.get_fixtures_dir(), migration_hash)
+
+    def make_data_migration(self, migration_name, only_models=None, dump_format=FixtureTable.FORMAT_JSONL,
+                            incremental=False, migration_time=None, filters=None, samples=None):
+        """
+        incremental - выгрузка только строк после отметок (watermarks) предыдущей миграции данных, см. dump_table;
+        новая миграция зависит от предыдущей.
+        filters - {модель: условие SQL}, samples - {модель: процент строк}, см. get_selection.
+        Отметки выгрузки берутся по всей таблице, поэтому выборка не сочетается с инкрементальной выгрузкой:
+        ни в одной миграции, ни в следующей за ней.
+        """
+        if dump_format == FixtureTable.FORMAT_COPY and self.config.db_type != 'postgres':
+            raise Exception('COPY format is supported only for postgres')
+        filtered = bool(filters or samples)
+        if incremental and filtered:
+            raise Exception('Incremental dump can not be filtered or sampled')
         only_models = only_models.split(',') if only_models else []
         inspector = Inspector(excluded_models=self.config.get_excluded())
 
-        data_to_save = {}
-        for model_class in inspector.get_database_models(self.db):
-            class_name = model_class.__name__
-            if only_models and class_name not in only_models:
-                continue
-            data = [model_to_dict(obj) for obj in model_class.select()]
-            if data:
-                data_to_save[class_name] = data
+        previous = self.get_last_data_migration() if incremental else None
+        previous_manifest = self.read_manifest(previous['hash']) if previous else {}
+        if previous_manifest.get('filtered'):
+            raise Exception('Incremental dump requires a full previous dump, {} is filtered or sampled'.format(
+                previous['hash']
+            ))
+        previous_watermarks = previous_manifest.get('watermarks', {})
 
-        migration_time = int(time.time())
+        # Таблица истории миграций не выгружается: загрузка фикстуры не должна менять список примененных миграций
+        service_tables = self.executor.state.tables
+        model_classes = [
+            model_class for model_class in inspector.get_database_models(self.db, excluded_tables=service_tables)
+            if not only_models or model_class.__name__ in only_models
+        ]
+        selection = self.get_selection(model_classes, filters, samples)
+
+        migration_time = migration_time or int(time.time())
         migration_hash = hashlib.md5(str(migration_time).encode('utf-8')).hexdigest()
-        fixture_path = os.path.join(self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), 'fixtures')
-        os.makedirs(fixture_path,  exist_ok=True)
-        fixture_file_name = os.path.join(fixture_path, '{}.json'.format(migration_hash))
-        with codecs.open(fixture_file_name, 'w', 'utf-8') as f:
-            f.write(json.dumps(data_to_save, cls=SafeEncoder, sort_keys=True, ensure_ascii=False, indent=1))
+        fixture_path = self.get_fixture_path(migration_hash)
+        if not os.path.exists(fixture_path):
+            os.makedirs(fixture_path)
+        dumped = self.dump_tables(
+            model_classes, fixture_path, dump_format, [previous_watermarks.get(x.__name__) for x in model_classes],
+            [selection[x.__name__] for x in model_classes]
+        )
+        tables = {}
+        watermarks = {}
+        for model_class, (table, watermark) in zip(model_classes, dumped):
+            if table is not None:
+                tables[model_class.__name__] = table
+            if watermark is not None:
+                watermarks[model_class.__name__] = watermark
+        with codecs.open(os.path.join(fixture_path, self.MANIFEST_FILE), 'w', 'utf-8') as f:
+            f.write(json.dumps(
+                {
+                    'tables': tables, 'watermarks': watermarks, 'base': previous['hash'] if previous else None,
+                    'filtered': filtered,
+                },
+                cls=TaggedEncoder, sort_keys=True, indent=1
+            ))
 
         up = [
             'from migrator import load_data',
             '',
-            'models = dict({})'.format(', '.join(['{}={}'.format(k, k) for k in data_to_save.keys()])),
+            'models = dict({})'.format(', '.join(['{}={}'.format(k, k) for k in sorted(tables.keys())])),
             "load_data(config, "
             "migration_hash='{migration_hash}', "
             "models=models"
@@ -58,34 +198,563 @@ class FixtureLoader(object):
             ),
         ]
 
-        db_models = list(inspector.inspect_database(self.db))
+        db_models = list(inspector.inspect_database(self.db, excluded_tables=service_tables))
         c = CodeGenerator(db_models)
         imports, models, proxies = c.clses_code()
 
         return self.executor.make_migration(
-            imports, models, up=up, down=None, migration_name=migration_name, proxies=proxies
+            imports, models, up=up, down=None, migration_name=migration_name, proxies=proxies,
+            dependencies=[previous] if previous else None, migration_time=migration_time
         )
 
-    def load_data(self, migration_hash, models):
-        migrations_path = self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR)
-        fixture_path = os.path.join(migrations_path, 'fixtures', migration_hash + '.json')
+    def get_last_data_migration(self):
+        """
+        Последняя по времени миграция, у которой есть фикстура с manifest.json
+        """
+        for migration in sorted(self.executor.get_migrations(), key=lambda x: -x['time']):
+            if os.path.exists(os.path.join(self.get_fixture_path(migration['hash']), self.MANIFEST_FILE)):
+                return migration
+
+    def read_manifest(self, migration_hash):
+        with codecs.open(os.path.join(self.get_fixture_path(migration_hash), self.MANIFEST_FILE), 'r', 'utf-8') as f:
+            return json.loads(f.read(), object_hook=self.object_hook)
+
+    def get_sample_condition(self, model_class, percent):
+        """
+        Детерминированная выборка: каждая N-я строка по целочисленному первичному ключу
+        """
+        pk = model_class._meta.primary_key
+        if not isinstance(pk, peewee.IntegerField):
+            raise Exception('Sampling of {} requires an integer primary key'.format(model_class.__name__))
+        if not 0 < float(percent) <= 100:
+            raise Exception('Sample percent of {} must be in (0, 100], got {}'.format(model_class.__name__, percent))
+        step = max(1, int(round(100.0 / float(percent))))
+        if self.config.db_type == 'sqlite':
+            return peewee.Expression(pk, peewee.OP.MOD, step) == 0
+        return peewee.fn.MOD(pk, step) == 0
+
+    def get_selection(self, model_classes, filters=None, samples=None):
+        """
+        Условия выборки строк по моделям (None - таблица целиком): фильтр filters (условие SQL)
+        и выборка samples (процент строк), дополненные строками, на которые ссылаются внешними ключами
+        выбранные строки других выгружаемых моделей, чтобы фикстура загружалась без нарушения ссылок.
+        Модели без условий, на которые ссылаются ограниченные выборки, выгружаются только в объеме ссылок.
+        Ссылки модели на саму себя и циклы внешних ключей замыкаются только на один уровень.
+        """
+        filters = filters or {}
+        samples = samples or {}
+        models = {model_class.__name__: model_class for model_class in model_classes}
+        unknown = (set(filters) | set(samples)) - set(models)
+        if unknown:
+            raise Exception('Unknown models in filters: {}'.format(', '.join(sorted(unknown))))
+        selection = {}
+        # Модели, на которые ссылаются, обрабатываются после ссылающихся на них
+        for layer in reversed(self.get_load_layers(models)):
+            for name in layer:
+                model_class = models[name]
+                where = None
+                if name in filters:
+                    condition = filters[name]
+                    if self.db.interpolation == '%s':
+                        condition = condition.replace('%', '%%')
+                    where = peewee.SQL('({})'.format(condition))
+                if name in samples:
+                    sample = self.get_sample_condition(model_class, samples[name])
+                    where = sample if where is None else where & sample
+                references, restricted = [], False
+                for child in model_classes:
+                    for field in child._meta.sorted_fields:
+                        if child is model_class or not isinstance(field, peewee.ForeignKeyField):
+                            continue
+                        if field.rel_model is not model_class:
+                            continue
+                        query = child.select(field).where(field.is_null(False))
+                        if selection.get(child.__name__) is not None:
+                            query = query.where(selection[child.__name__])
+                            restricted = True
+                        references.append(field.to_field << query)
+                # Модель без своих условий ограничивается строками, на которые ссылаются,
+                # если выборка хотя бы одной ссылающейся на нее модели ограничена
+                if where is not None or restricted:
+                    for reference in references:
+                        where = reference if where is None else where | reference
+                selection[name] = where
+        return selection
+
+    def get_watermark_field(self, model_class):
+        """
+        Поле отметки выгрузки: колонка из настройки fixture_watermarks (например, время изменения строки)
+        или целочисленный первичный ключ. По первичному ключу выгрузка только дополняет таблицу:
+        измененные строки в нее не попадают.
+        """
+        watermarks = self.config.get_fixture_watermarks()
+        meta = model_class._meta
+        name = watermarks.get(model_class.__name__, watermarks.get(meta.db_table))
+        if name is not None:
+            field = meta.fields.get(name) or {x.db_column: x for x in meta.sorted_fields}.get(name)
+            if field is None:
+                raise Exception('No field {} in model {}'.format(name, model_class.__name__))
+            return field
+        if isinstance(meta.primary_key, peewee.IntegerField):
+            return meta.primary_key
+
+    def dump_table(self, dump, model_class, fixture_path, previous=None, where=None):
+        """
+        Выгрузка строк таблицы, подходящих под условие where, и отметка для следующей инкрементальной
+        выгрузки. Если задана отметка предыдущей выгрузки previous, выгружаются только строки после нее,
+        для колонки изменений - и строки с тем же значением, что у отметки: они могли быть записаны позже
+        чтения отметки и при загрузке перезаписываются.
+        """
+        field = self.get_watermark_field(model_class)
+        if field is None:
+            return dump(model_class, fixture_path, where), None
+        value = field.python_value(model_class.select(peewee.fn.MAX(field)).scalar())
+        if value is None:
+            return dump(model_class, fixture_path, where), None
+        # Строки, появившиеся после чтения отметки, попадут в следующую выгрузку
+        watermark = field <= value
+        if previous is not None and previous['field'] == field.name:
+            if field is model_class._meta.primary_key:
+                watermark &= field > previous['value']
+            else:
+                watermark &= field >= previous['value']
+        where = watermark if where is None else where & watermark
+        return dump(model_class, fixture_path, where), {'field': field.name, 'value': value}
+
+    def dump_tables(self, model_classes, fixture_path, dump_format=FixtureTable.FORMAT_JSONL, watermarks=None,
+                    wheres=None):
+        """
+        Выгрузка таблиц из одного снимка базы. В PostgreSQL таблицы читаются параллельно потоками,
+        которые подключаются к снимку основной транзакции (pg_export_snapshot), в остальных базах -
+        последовательно в одной транзакции.
+        Результат - пары (описание таблицы для manifest.json, отметка выгрузки) для каждой модели.
+        """
+        service_tables = set(self.executor.state.tables)
+        for model_class in model_classes:
+            if model_class._meta.db_table in service_tables:
+                raise Exception('Table {} of migrations state can not be dumped'.format(model_class._meta.db_table))
+        dump = self.dump_model_copy if dump_format == FixtureTable.FORMAT_COPY else self.dump_model
+        tasks = list(zip(
+            model_classes, watermarks or [None] * len(model_classes), wheres or [None] * len(model_classes)
+        ))
+        if self.workers == 1 or self.config.db_type != 'postgres' or len(model_classes) < 2:
+            with self.db.atomic():
+                return [self.dump_table(dump, x, fixture_path, previous, where) for x, previous, where in tasks]
+        if not self.db.transaction_depth():
+            # Завершаем неявную транзакцию psycopg2, уровень изоляции задается первым запросом транзакции
+            self.db.commit()
+        with self.db.transaction():
+            self.db.execute_sql('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            snapshot, = self.db.execute_sql('SELECT pg_export_snapshot()').fetchone()
+            pool = ThreadPool(min(self.workers, len(model_classes)))
+            try:
+                # Снимок доступен, пока открыта экспортировавшая его транзакция
+                return pool.map(
+                    self._dump_in_snapshot,
+                    [(dump, x, fixture_path, previous, where, snapshot) for x, previous, where in tasks], chunksize=1
+                )
+            finally:
+                pool.close()
+                pool.join()
+
+    def _dump_in_snapshot(self, task):
+        dump, model_class, fixture_path, previous, where, snapshot = task
+        try:
+            with self.db.transaction():
+                self.db.execute_sql('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+                self.db.execute_sql("SET TRANSACTION SNAPSHOT '{}'".format(snapshot))
+                return self.dump_table(dump, model_class, fixture_path, previous, where)
+        finally:
+            self.db.close()
+
+    def iter_rows(self, model_class, where=None):
+        """
+        Строки таблицы порциями по chunk_size, упорядоченными по первичному ключу
+        """
+        pk = model_class._meta.primary_key
+        if pk is None or isinstance(pk, peewee.CompositeKey):
+            query = model_class.select().dicts()
+            if where is not None:
+                query = query.where(where)
+            for row in query.iterator():
+                yield row
+            return
+        last = None
+        while True:
+            query = model_class.select().order_by(pk).limit(self.chunk_size).dicts()
+            if where is not None:
+                query = query.where(where)
+            if last is not None:
+                query = query.where(pk > last)
+            rows = list(query)
+            for row in rows:
+                yield row
+            if len(rows) < self.chunk_size:
+                break
+            last = rows[-1][pk.name]
+
+    def get_writer(self, extension):
+        return ChunkWriter(self.store, extension, self.compression, self.chunk_rows)
+
+    def dump_model(self, model_class, fixture_path, where=None):
+        codec = RowCodec(model_class)
+        encoder = self.encoder(sort_keys=True, ensure_ascii=False)
+        writer = self.get_writer(FixtureTable.FORMAT_JSONL)
+        for row in self.iter_rows(model_class, where):
+            writer.write(encoder.encode(codec.encode(row)) + '\n')
+        chunks = writer.close()
+        if not writer.rows:
+            return None
+        return {
+            'rows': writer.rows, 'codec': FixtureTable.CODEC_TAGGED, 'compression': self.compression,
+            'chunks': chunks
+        }
+
+    @staticmethod
+    def pg_name(model_class, name=None):
+        meta = model_class._meta
+        name = '"{}"'.format(name or meta.db_table)
+        return '"{}".{}'.format(meta.schema, name) if meta.schema else name
+
+    def dump_model_copy(self, model_class, fixture_path, where=None):
+        """
+        Выгрузка таблицы PostgreSQL через COPY ... TO STDOUT напрямую в файлы частей
+        """
+        fields = model_class._meta.sorted_fields
+        pk = model_class._meta.primary_key
+        query = model_class.select(*fields)
+        if pk is not None and not isinstance(pk, peewee.CompositeKey):
+            query = query.order_by(pk)
+        if where is not None:
+            query = query.where(where)
+        cursor = self.db.get_cursor()
+        # COPY не принимает параметры запроса, они подставляются в текст средствами psycopg2
+        sql = cursor.mogrify(*query.sql())
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8')
+        writer = self.get_writer(FixtureTable.FORMAT_COPY)
+        cursor.copy_expert('COPY ({}) TO STDOUT'.format(sql), writer)
+        chunks = writer.close()
+        if not writer.rows:
+            return None
+        return {
+            'rows': writer.rows, 'format': FixtureTable.FORMAT_COPY, 'columns': [field.name for field in fields],
+            'compression': self.compression, 'chunks': chunks
+        }
+
+    def gc(self, dry_run=False):
+        """
+        Удаление фикстур удаленных миграций и частей, на которые не ссылается ни одна фикстура.
+        Результат - пути удаленных директорий фикстур и файлов частей.
+        """
+        fixtures_path = self.get_fixtures_dir()
+        # Список миграций перечитывается с диска: миграции могли удалить после создания загрузчика
+        migrations = set(x['hash'] for x in Executor(config=self.config).get_migrations())
+        removed = []
+        referenced = set()
+        for name in sorted(os.listdir(fixtures_path)) if os.path.isdir(fixtures_path) else []:
+            path = os.path.join(fixtures_path, name)
+            if name == self.CHUNKS_DIR or not os.path.isdir(path):
+                continue
+            if name not in migrations:
+                removed.append(path)
+                if not dry_run:
+                    shutil.rmtree(path)
+                continue
+            if os.path.exists(os.path.join(path, self.MANIFEST_FILE)):
+                for table in self.read_manifest(name)['tables'].values():
+                    referenced.update(chunk['sha256'] for chunk in table.get('chunks', []))
+        return removed + self.store.gc(referenced, dry_run=dry_run)
+
+    def read_fixture(self, migration_hash):
+        """
+        Словарь модель -> FixtureTable
+        """
+        fixture_path = self.get_fixture_path(migration_hash)
+        if os.path.isdir(fixture_path):
+            tables = self.read_manifest(migration_hash)['tables']
+            return {
+                model_name: FixtureTable(meta=table, store=self.store, object_hook=self.object_hook)
+                for model_name, table in tables.items()
+            }
+        # Фикстура старого формата - единый файл <migration_hash>.json
+        fixture_path = '{}.json'.format(fixture_path)
         if not os.path.exists(fixture_path):
             raise Exception('No fixture file at the {}'.format(fixture_path))
         with codecs.open(fixture_path, 'r', 'utf-8') as f:
             data = f.read()
-        fixture = json.loads(data, encoding='utf-8', object_hook=pickle_hook)
+        return {
+            model_name: FixtureTable(rows=rows)
+            for model_name, rows in json.loads(data, object_hook=self.object_hook).items()
+        }
+
+    @staticmethod
+    def get_load_layers(models):
+        """
+        Имена моделей по слоям: модели слоя ссылаются внешними ключами только на модели предыдущих слоев.
+        Модели, связанные циклом внешних ключей, попадают в последний слой.
+        """
+        names = {model_class: name for name, model_class in models.items()}
+        parents = {
+            name: set(
+                names[field.rel_model] for field in model_class._meta.sorted_fields
+                if isinstance(field, peewee.ForeignKeyField)
+                and field.rel_model in names and field.rel_model is not model_class
+            )
+            for name, model_class in models.items()
+        }
+        layers = []
+        while parents:
+            layer = sorted(name for name, x in parents.items() if not x)
+            if not layer:
+                layers.append(sorted(parents))
+                break
+            layers.append(layer)
+            for name in layer:
+                del parents[name]
+            for x in parents.values():
+                x.difference_update(layer)
+        return layers
+
+    def load_data(self, migration_hash, models):
+        fixture = self.read_fixture(migration_hash)
+        tasks = [
+            [(models[name], fixture[name]) for name in layer if fixture.get(name)]
+            for layer in self.get_load_layers(models)
+        ]
+        try:
+            self.load_layers(tasks)
+        finally:
+            self.store.save_verified()
+
+    def load_layers(self, tasks):
+        # Внутри открытой транзакции все таблицы загружаются в ней, в одном соединении
+        if self.workers == 1 or self.db.transaction_depth():
+            restore = self.tune_session() if self.fast_load else []
+            self._preload()
+            try:
+                for layer in tasks:
+                    for model_class, table in layer:
+                        self.load_model_table(model_class, table)
+            finally:
+                self._postload()
+                self.restore_session(restore)
+            return
+        pool = ThreadPool(self.workers)
+        try:
+            for layer in tasks:
+                # Таблицы слоя загружаются параллельно, следующий слой - после фиксации предыдущего
+                pool.map(self._load_in_thread, layer)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _load_in_thread(self, task):
+        """
+        Загрузка таблицы в потоке пула: у каждого потока свое соединение с базой и свои настройки сессии
+        """
+        model_class, table = task
+        restore = self.tune_session() if self.fast_load else []
         self._preload()
-        for model_name, model_class in models.items():
-            data = fixture.get(model_name, [])
-            if not data:
-                continue
+        try:
+            self.load_model_table(model_class, table)
+        finally:
+            self._postload()
+            self.restore_session(restore)
+            self.db.close()
+
+    def load_model_table(self, model_class, table):
+        indexes = self.drop_indexes(model_class) if self.fast_load else []
+        try:
             self._model_preload(model_class)
-            for row in data:
+            with self.db.atomic():
+                self.load_table(model_class, table)
+            self._model_postload(model_class)
+        except Exception:
+            # Индексы восстанавливаются и при ошибке загрузки, но ошибка их создания не подменяет исходную
+            exc_info = sys.exc_info()
+            for sql in indexes:
+                try:
+                    self.db.execute_sql(sql)
+                except Exception:
+                    logger.exception('Failed to restore index of %s: %s', model_class._meta.db_table, sql)
+            six.reraise(*exc_info)
+        # Построение индекса по загруженным данным быстрее, чем его обновление на каждую строку
+        for sql in indexes:
+            self.db.execute_sql(sql)
+
+    def tune_session(self):
+        """
+        Настройки сессии для быстрой загрузки. Результат - запросы, возвращающие прежние значения.
+        """
+        restore = []
+        if self.config.db_type == 'sqlite':
+            synchronous, = self.db.execute_sql('PRAGMA synchronous').fetchone()
+            self.db.execute_sql('PRAGMA synchronous = OFF')
+            restore.append('PRAGMA synchronous = {}'.format(synchronous))
+            # Режим журнала не меняется внутри транзакции, режим WAL сохраняется в файле базы - его не трогаем
+            if not self.db.transaction_depth():
+                journal_mode, = self.db.execute_sql('PRAGMA journal_mode').fetchone()
+                if journal_mode.lower() != 'wal':
+                    self.db.execute_sql('PRAGMA journal_mode = MEMORY')
+                    restore.append('PRAGMA journal_mode = {}'.format(journal_mode))
+        elif self.config.db_type == 'mysql':
+            unique_checks, = self.db.execute_sql('SELECT @@unique_checks').fetchone()
+            self.db.execute_sql('SET unique_checks = 0')
+            restore.append('SET unique_checks = {}'.format(unique_checks))
+        elif self.config.db_type == 'postgres':
+            synchronous_commit, = self.db.execute_sql('SHOW synchronous_commit').fetchone()
+            self.db.execute_sql('SET synchronous_commit = off')
+            restore.append("SET synchronous_commit = '{}'".format(synchronous_commit))
+        return restore
+
+    def restore_session(self, restore):
+        for sql in reversed(restore):
+            self.db.execute_sql(sql)
+
+    def drop_indexes(self, model_class):
+        """
+        Удаление неуникальных индексов таблицы перед загрузкой. Результат - запросы для их создания.
+        """
+        meta = model_class._meta
+        if self.config.db_type == 'mysql' and self.db.transaction_depth():
+            # DDL в MySQL завершает транзакцию
+            return []
+        foreign_keys = set(
+            field.db_column for field in meta.sorted_fields if isinstance(field, peewee.ForeignKeyField)
+        )
+        indexes = self.db.get_indexes(meta.db_table, meta.schema) if meta.schema else self.db.get_indexes(meta.db_table)
+        create = []
+        for index in indexes:
+            if index.unique:
+                continue
+            if self.config.db_type == 'mysql':
+                # Индекс по внешнему ключу MySQL удалить не даст
+                if index.columns[0] in foreign_keys:
+                    continue
+                drop = 'DROP INDEX `{}` ON `{}`'.format(index.name, meta.db_table)
+                sql = 'CREATE INDEX `{}` ON `{}` ({})'.format(
+                    index.name, meta.db_table, ', '.join('`{}`'.format(x) for x in index.columns)
+                )
+            elif index.sql:
+                drop = 'DROP INDEX {}'.format(self._with_schema(model_class, '"{}"'.format(index.name)))
+                sql = index.sql
+            else:
+                continue
+            self.db.execute_sql(drop)
+            create.append(sql)
+        return create
+
+    def load_table(self, model_class, table):
+        if self.use_copy and self.config.db_type == 'postgres':
+            if table.format == FixtureTable.FORMAT_COPY:
+                fields = [model_class._meta.fields[name] for name in table.meta['columns']]
+                self.load_copy(model_class, fields, CopyStream(table.iter_lines()))
+            else:
+                fields = model_class._meta.sorted_fields
+                lines = (
+                    encode_row(field.db_value(row.get(field.name)) for field in fields)
+                    for row in self.normalize_rows(model_class, table.iter_rows(model_class))
+                )
+                self.load_copy(model_class, fields, CopyStream(lines))
+        else:
+            self.load_model(model_class, table.iter_rows(model_class))
+
+    def load_copy(self, model_class, fields, stream):
+        """
+        COPY во временную таблицу и перенос в основную с заменой существующих по первичному ключу строк
+        """
+        meta = model_class._meta
+        table = self.pg_name(model_class)
+        temp_table = '"migrator_copy_{}"'.format(meta.db_table)
+        columns = ', '.join('"{}"'.format(field.db_column) for field in fields)
+        cursor = self.db.get_cursor()
+        cursor.execute('CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(
+            temp_table, table
+        ))
+        cursor.copy_expert('COPY {} ({}) FROM STDIN'.format(temp_table, columns), stream)
+        pk = meta.primary_key
+        if pk is None or isinstance(pk, peewee.CompositeKey):
+            conflict = 'ON CONFLICT DO NOTHING'
+        else:
+            update = ', '.join(
+                '"{0}" = EXCLUDED."{0}"'.format(field.db_column) for field in fields if field is not pk
+            )
+            conflict = 'ON CONFLICT ("{}") DO {}'.format(pk.db_column, 'UPDATE SET ' + update if update else 'NOTHING')
+        cursor.execute('INSERT INTO {table} ({columns}) SELECT {columns} FROM {temp_table} {conflict}'.format(
+            table=table, columns=columns, temp_table=temp_table, conflict=conflict
+        ))
+        cursor.execute('DROP TABLE {}'.format(temp_table))
+
+    def get_batch_size(self, model_class):
+        # Все поля модели попадают в INSERT, каждое значение - отдельный параметр запроса
+        return max(1, self.config.max_query_params // max(1, len(model_class._meta.fields)))
+
+    def normalize_rows(self, model_class, rows):
+        foreign_keys = [
+            field for field in model_class._meta.sorted_fields if isinstance(field, peewee.ForeignKeyField)
+        ]
+        for row in rows:
+            for field in foreign_keys:
+                # Фикстуры старого формата хранят связанный объект целиком
+                value = row.get(field.name)
+                if isinstance(value, dict):
+                    row[field.name] = value.get(field.to_field.name)
+            yield row
+
+    def load_model(self, model_class, rows):
+        batch_size = self.get_batch_size(model_class)
+        batch = []
+        for row in self.normalize_rows(model_class, rows):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                self.load_batch(model_class, batch)
+                batch = []
+        if batch:
+            self.load_batch(model_class, batch)
+
+    def load_batch(self, model_class, rows):
+        pk = model_class._meta.primary_key
+        if pk is None or isinstance(pk, peewee.CompositeKey):
+            for row in rows:
                 instance = dict_to_model(model_class, row)
                 exist = model_class.select().where(instance._pk_expr()).first()
                 instance.save(force_insert=not bool(exist))
-            self._model_postload(model_class)
-        self._postload()
+        elif self.db.upsert_sql:
+            # INSERT OR REPLACE (sqlite), REPLACE (mysql)
+            model_class.insert_many(rows).upsert().execute()
+        elif self.config.db_type == 'postgres':
+            self._upsert_postgres(model_class, rows)
+        else:
+            self._load_batch_by_existing(model_class, rows)
+
+    def _upsert_postgres(self, model_class, rows):
+        meta = model_class._meta
+        sql, params = model_class.insert_many(rows).sql()
+        columns = [
+            meta.fields[name].db_column for name in rows[0]
+            if name in meta.fields and meta.fields[name] is not meta.primary_key
+        ]
+        if columns:
+            action = 'UPDATE SET {}'.format(', '.join('"{0}" = EXCLUDED."{0}"'.format(x) for x in columns))
+        else:
+            action = 'NOTHING'
+        sql = '{} ON CONFLICT ("{}") DO {}'.format(sql, meta.primary_key.db_column, action)
+        self.db.execute_sql(sql, params)
+
+    def _load_batch_by_existing(self, model_class, rows):
+        pk = model_class._meta.primary_key
+        existing = set(
+            value for value, in model_class.select(pk).where(pk << [row[pk.name] for row in rows]).tuples()
+        )
+        new_rows = [row for row in rows if row[pk.name] not in existing]
+        if new_rows:
+            model_class.insert_many(new_rows).execute()
+        for row in rows:
+            if row[pk.name] in existing:
+                data = {k: v for k, v in row.items() if k != pk.name}
+                if data:
+                    model_class.update(**data).where(pk == row[pk.name]).execute()
 
     def _preload(self):
         if self.config.db_type == 'mysql':
@@ -95,22 +764,26 @@ class FixtureLoader(object):
         if self.config.db_type == 'mysql':
             self.db.execute_sql('SET foreign_key_checks = 1;')
 
+    @staticmethod
+    def _with_schema(model_class, name):
+        schema = model_class._meta.schema
+        return '{}.{}'.format(schema, name) if schema else name
+
     def _model_preload(self, model_class):
         if self.config.db_type == 'postgres':
-            schema = ''
-            if model_class._meta.schema:
-                schema = '{}.'.format(model_class._meta.schema)
-            self._with_schema = lambda x: '{}{}'.format(schema, x)
-            self._table = self._with_schema(model_class._meta.db_table)
-            model_class.raw('ALTER TABLE {} DISABLE TRIGGER USER;'.format(self._table)).execute()
+            table = self._with_schema(model_class, model_class._meta.db_table)
+            model_class.raw('ALTER TABLE {} DISABLE TRIGGER USER;'.format(table)).execute()
 
     def _model_postload(self, model_class):
         if self.config.db_type == 'postgres':
-            model_class.raw('ALTER TABLE {} ENABLE TRIGGER USER;'.format(self._table)).execute()
-            seq = self._with_schema('{}_{}_seq'.format(model_class._meta.db_table, model_class._meta.primary_key.db_column))
+            table = self._with_schema(model_class, model_class._meta.db_table)
+            model_class.raw('ALTER TABLE {} ENABLE TRIGGER USER;'.format(table)).execute()
+            seq = self._with_schema(
+                model_class, '{}_{}_seq'.format(model_class._meta.db_table, model_class._meta.primary_key.db_column)
+            )
             model_class.raw(
                 "SELECT setval('{seq}', (SELECT COALESCE(MAX(id)+(SELECT increment_by FROM {seq}), "
-                "(SELECT min_value FROM {seq})) FROM {table}), false)".format(seq=seq, table=self._table)
+                "(SELECT min_value FROM {seq})) FROM {table}), false)".format(seq=seq, table=table)
             ).execute()
         elif self.config.db_type == 'mysql':
             max_val = model_class.select(peewee.fn.Max(model_class._get_pk_value(model_class))).scalar()
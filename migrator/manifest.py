@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import ast
+import bisect
+import codecs
+import hashlib
+import json
+import os
+
+__all__ = ['Manifest', 'read_header']
+
+HEADER_CONSTANTS = {
+    'MIGRATION_NAME': 'name',
+    'MIGRATION_TIME': 'time',
+    'MIGRATION_DEPENDENCIES': 'dependencies',
+}
+
+
+def read_header(path):
+    """
+    Чтение констант заголовка миграции без выполнения модуля.
+    Разбирается только начало файла, до первого определения класса или функции.
+    Возвращает None, если константы не удалось получить как литералы (например, в написанной вручную миграции).
+    """
+    lines = []
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith((b'class ', b'def ', b'@')):
+                break
+            lines.append(line)
+    try:
+        tree = ast.parse(b''.join(lines))
+    except SyntaxError:
+        return None
+    header = {}
+    for node in tree.body:
+        if not isinstance(node, ast.Assign) or len(node.targets) != 1:
+            continue
+        target = node.targets[0]
+        if isinstance(target, ast.Name) and target.id in HEADER_CONSTANTS:
+            try:
+                header[HEADER_CONSTANTS[target.id]] = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+    if len(header) != len(HEADER_CONSTANTS):
+        return None
+    return header
+
+
+class Manifest(object):
+    """
+    Индекс директории миграций: заголовки миграций (имя, время, зависимости) и отпечаток файла
+    (mtime, size, checksum). Позволяет получать список миграций без импорта их модулей.
+    """
+    FILE_NAME = '.manifest.json'
+    VERSION = 1
+
+    def __init__(self, migrations_dir, header_loader):
+        self.migrations_dir = migrations_dir
+        # header_loader(revision, path) -> {'name': ..., 'time': ..., 'dependencies': [...]}
+        self.header_loader = header_loader
+        self._entries = None
+        self._hashes = None
+
+    @property
+    def path(self):
+        return os.path.join(self.migrations_dir, self.FILE_NAME)
+
+    @staticmethod
+    def file_name(revision):
+        return 'migration_{}.py'.format(revision)
+
+    @staticmethod
+    def revision_by_file(file_name):
+        if file_name.startswith('migration_') and file_name.endswith('.py'):
+            return file_name.split('migration_', 1)[-1].rsplit('.py', 1)[0]
+        return None
+
+    @staticmethod
+    def checksum(path):
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(65536), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def load(self):
+        try:
+            with codecs.open(self.path, 'r', 'utf-8') as f:
+                data = json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return {}
+        if data.get('version') != self.VERSION:
+            return {}
+        return data.get('migrations', {})
+
+    def save(self, entries):
+        with codecs.open(self.path, 'w', 'utf-8') as f:
+            f.write(json.dumps({'version': self.VERSION, 'migrations': entries}, sort_keys=True, indent=1))
+
+    def entries(self):
+        """
+        Актуальные записи манифеста. Перечитываются только добавленные или измененные файлы.
+        """
+        if self._entries is None:
+            self._entries = self.refresh(self.load())
+            self._hashes = None
+        return self._entries
+
+    def hashes(self):
+        """
+        Отсортированный список ревизий для поиска по префиксу
+        """
+        if self._hashes is None:
+            self._hashes = sorted(self.entries())
+        return self._hashes
+
+    def find(self, prefix):
+        hashes = self.hashes()
+        found = []
+        i = bisect.bisect_left(hashes, prefix)
+        while i < len(hashes) and hashes[i].startswith(prefix):
+            found.append(hashes[i])
+            i += 1
+        return found
+
+    def refresh(self, known):
+        entries = {}
+        changed = False
+        for file_name in os.listdir(self.migrations_dir):
+            revision = self.revision_by_file(file_name)
+            if revision is None:
+                continue
+            path = os.path.join(self.migrations_dir, file_name)
+            stat = os.stat(path)
+            entry = known.get(revision)
+            if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                entries[revision] = entry
+                continue
+            checksum = self.checksum(path)
+            if entry is None or entry['checksum'] != checksum:
+                entry = self.make_entry(revision, self.header_loader(revision, path), checksum)
+            entry.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+            entries[revision] = entry
+            changed = True
+        if changed or set(known) != set(entries):
+            self.save(entries)
+        return entries
+
+    @staticmethod
+    def make_entry(revision, header, checksum):
+        return {
+            'hash': revision,
+            'name': header['name'],
+            'time': header['time'],
+            'dependencies': list(header['dependencies'] or []),
+            'checksum': checksum,
+        }
+
+    def get(self, revision):
+        return self.entries().get(revision)
+
+    def add(self, revision, name, time, dependencies):
+        """
+        Регистрация только что созданной миграции, без повторного чтения ее заголовка.
+        Еще не прочитанный манифест не обновляется по директории: запись добавляется в сохраненный файл,
+        остальные файлы проверяются при первом обращении к entries().
+        """
+        entries = self.load() if self._entries is None else self._entries
+        path = os.path.join(self.migrations_dir, self.file_name(revision))
+        stat = os.stat(path)
+        entry = self.make_entry(
+            revision, {'name': name, 'time': time, 'dependencies': dependencies}, self.checksum(path)
+        )
+        entry.update({'mtime': stat.st_mtime, 'size': stat.st_size})
+        entries[revision] = entry
+        self._hashes = None
+        self.save(entries)
+        return entry
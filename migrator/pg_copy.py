@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Текстовый формат COPY PostgreSQL: строка таблицы - одна строка, значения разделены табуляцией,
+NULL записывается как \\N, спецсимволы экранируются обратной косой чертой.
+"""
+
+from __future__ import unicode_literals
+
+import binascii
+import datetime
+import decimal
+import uuid
+
+import peewee
+import six
+
+__all__ = ['encode_value', 'encode_row', 'decode_line', 'decode_value', 'CopyStream']
+
+NULL = '\\N'
+
+_ESCAPE = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+_UNESCAPE = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', 'N': None}
+
+
+def _escape(text):
+    if not any(char in text for char in _ESCAPE):
+        return text
+    return ''.join(_ESCAPE.get(char, char) for char in text)
+
+
+def encode_value(value):
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    if isinstance(value, (bytes, bytearray)) and not isinstance(value, six.text_type):
+        # bytea в шестнадцатеричном представлении
+        return _escape('\\x{}'.format(binascii.hexlify(bytes(value)).decode('ascii')))
+    if isinstance(value, six.integer_types + (float, decimal.Decimal, uuid.UUID)):
+        return six.text_type(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        # Дата и время в виде "YYYY-MM-DD HH:MM:SS", как их выводит PostgreSQL
+        return six.text_type(value)
+    return _escape(six.text_type(value))
+
+
+def encode_row(values):
+    return '\t'.join(encode_value(value) for value in values) + '\n'
+
+
+def decode_line(line):
+    """
+    Значения строки COPY в виде текста (None для NULL)
+    """
+    values = []
+    for raw in line.rstrip('\n').split('\t'):
+        if raw == NULL:
+            values.append(None)
+        elif '\\' not in raw:
+            values.append(raw)
+        else:
+            chars = []
+            i = 0
+            while i < len(raw):
+                char = raw[i]
+                if char == '\\' and i + 1 < len(raw):
+                    i += 1
+                    char = _UNESCAPE.get(raw[i], raw[i])
+                chars.append(char)
+                i += 1
+            values.append(''.join(chars))
+    return values
+
+
+def decode_value(field, text):
+    if text is None:
+        return None
+    if isinstance(field, peewee.BooleanField):
+        return text in ('t', 'true', '1')
+    if isinstance(field, peewee.BlobField):
+        if text.startswith('\\x'):
+            return binascii.unhexlify(text[2:].encode('ascii'))
+        return text.encode('utf-8')
+    return field.python_value(text)
+
+
+class CopyStream(object):
+    """
+    Файлоподобный объект для COPY ... FROM STDIN поверх итератора строк
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if not self.buffer:
+            self.buffer = next(self.lines, '')
+        return self.read(len(self.buffer) if size < 0 else min(size, len(self.buffer)))
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import heapq
+
+__all__ = ['Planner', 'PlanError']
+
+
+class PlanError(Exception):
+    pass
+
+
+class Planner(object):
+    """
+    Граф зависимостей миграций (MIGRATION_DEPENDENCIES), строится один раз по всем миграциям;
+    план проверяется только по нужным для его целей миграциям
+    """
+
+    def __init__(self, migrations):
+        self.migrations = {x['hash']: x for x in migrations}
+
+    def validate(self, revisions, applied=()):
+        """
+        Проверка зависимостей ревизий revisions (замыкания целей плана): отсутствующие миграции и циклы.
+        Остальные миграции графа не проверяются.
+        """
+        applied = set(applied)
+        missing = []
+        for revision in sorted(revisions):
+            for dep in self.migrations[revision]['dependencies']:
+                if dep not in self.migrations and dep not in applied:
+                    missing.append('{} -> {}'.format(revision, dep))
+        if missing:
+            raise PlanError('Missing dependencies: {}'.format(', '.join(missing)))
+        cycle = self.find_cycle(revisions)
+        if cycle:
+            raise PlanError('Dependency cycle: {}'.format(' -> '.join(cycle)))
+
+    def find_cycle(self, revisions):
+        # 0 - не посещена, 1 - в обработке, 2 - обработана
+        state = dict.fromkeys(revisions, 0)
+        for root in sorted(state):
+            if state[root]:
+                continue
+            path = [root]
+            stack = [iter(self.dependencies(root))]
+            state[root] = 1
+            while stack:
+                dep = next(stack[-1], None)
+                if dep is None:
+                    state[path.pop()] = 2
+                    stack.pop()
+                elif dep not in state:
+                    continue
+                elif state[dep] == 1:
+                    return path[path.index(dep):] + [dep]
+                elif state[dep] == 0:
+                    state[dep] = 1
+                    path.append(dep)
+                    stack.append(iter(self.dependencies(dep)))
+        return None
+
+    def dependencies(self, revision):
+        return sorted(dep for dep in self.migrations[revision]['dependencies'] if dep in self.migrations)
+
+    def pending(self, targets, applied):
+        """
+        Неприменные миграции, необходимые для targets, вместе с их зависимостями.
+        Возвращает словарь ревизия -> позиция первой требующей ее цели.
+        """
+        positions = {}
+        for position, target in enumerate(targets):
+            if target not in self.migrations:
+                raise PlanError('Migration {} not found'.format(target))
+            stack = [target]
+            while stack:
+                revision = stack.pop()
+                if revision in applied or revision in positions:
+                    continue
+                positions[revision] = position
+                stack.extend(self.dependencies(revision))
+        return positions
+
+    def order(self, positions):
+        """
+        Топологическая сортировка: зависимости раньше зависимых, при прочих равных - по позиции цели,
+        времени и хэшу миграции
+        """
+        waiting = {}
+        dependents = {}
+        for revision in positions:
+            deps = [dep for dep in self.dependencies(revision) if dep in positions]
+            waiting[revision] = len(deps)
+            for dep in deps:
+                dependents.setdefault(dep, []).append(revision)
+
+        def key(rev):
+            return positions[rev], self.migrations[rev]['time'], rev
+
+        ready = [key(rev) for rev, count in waiting.items() if not count]
+        heapq.heapify(ready)
+        ordered = []
+        while ready:
+            revision = heapq.heappop(ready)[-1]
+            ordered.append(self.migrations[revision])
+            for dependent in dependents.get(revision, []):
+                waiting[dependent] -= 1
+                if not waiting[dependent]:
+                    heapq.heappush(ready, key(dependent))
+        if len(ordered) != len(positions):
+            raise PlanError('Dependency cycle between: {}'.format(
+                ', '.join(sorted(rev for rev, count in waiting.items() if count))
+            ))
+        return ordered
+
+    def plan(self, targets, applied):
+        applied = set(applied)
+        positions = self.pending(targets, applied)
+        self.validate(positions, applied)
+        return self.order(positions)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Чтение схемы базы данных только для нужных таблиц. Для PostgreSQL столбцы, ключи и индексы всех таблиц
+читаются несколькими общими запросами к каталогу, для MySQL и SQLite - запросами по каждой таблице.
+Прочитанная схема сохраняется в файл вместе с отпечатком схемы (fingerprint); пока отпечаток не изменился,
+каталог базы повторно не читается.
+"""
+
+from __future__ import unicode_literals
+
+import codecs
+import hashlib
+import json
+import os
+from collections import OrderedDict
+
+import peewee
+import six
+from peewee import MySQLDatabase, PostgresqlDatabase, PrimaryKeyField, IntegerField
+from playhouse.reflection import Column, Introspector, UnknownField
+
+try:
+    from playhouse import postgres_ext
+except ImportError:
+    postgres_ext = None
+
+__all__ = ['SchemaReflector', 'schema_fingerprint']
+
+# Меняется при изменении формата кеша
+CACHE_VERSION = 1
+
+_PG_FINGERPRINT = """
+SELECT
+    (SELECT md5(coalesce(string_agg(
+        c.relname || ' ' || a.attname || ' ' || a.atttypid || ' ' || a.atttypmod || ' ' || a.attnotnull,
+        ',' ORDER BY c.relname, a.attnum
+    ), ''))
+    FROM pg_catalog.pg_attribute AS a
+    JOIN pg_catalog.pg_class AS c ON c.oid = a.attrelid
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s AND c.relkind = 'r' AND a.attnum > 0 AND NOT a.attisdropped),
+    (SELECT md5(coalesce(string_agg(
+        con.conrelid::regclass::text || ' ' || con.conname || ' ' || pg_get_constraintdef(con.oid),
+        ',' ORDER BY con.conrelid::regclass::text, con.conname
+    ), ''))
+    FROM pg_catalog.pg_constraint AS con
+    JOIN pg_catalog.pg_namespace AS n ON n.oid = con.connamespace
+    WHERE n.nspname = %s),
+    (SELECT md5(coalesce(string_agg(tablename || ' ' || indexdef, ',' ORDER BY tablename, indexname), ''))
+    FROM pg_catalog.pg_indexes
+    WHERE schemaname = %s)
+"""
+
+_MYSQL_FINGERPRINT = (
+    """
+    SELECT table_name, column_name, column_type, is_nullable, column_key
+    FROM information_schema.columns
+    WHERE table_schema = DATABASE()
+    ORDER BY table_name, ordinal_position
+    """,
+    """
+    SELECT table_name, index_name, column_name, non_unique
+    FROM information_schema.statistics
+    WHERE table_schema = DATABASE()
+    ORDER BY table_name, index_name, seq_in_index
+    """,
+    """
+    SELECT table_name, column_name, referenced_table_name, referenced_column_name
+    FROM information_schema.key_column_usage
+    WHERE table_schema = DATABASE() AND referenced_table_name IS NOT NULL
+    ORDER BY table_name, column_name
+    """,
+)
+
+_PG_COLUMNS = """
+SELECT c.relname, a.attname, format_type(a.atttypid, a.atttypmod), NOT a.attnotnull, a.atttypid
+FROM pg_catalog.pg_attribute AS a
+JOIN pg_catalog.pg_class AS c ON c.oid = a.attrelid
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+WHERE n.nspname = %s AND c.relname = ANY(%s) AND c.relkind = 'r' AND a.attnum > 0 AND NOT a.attisdropped
+ORDER BY c.relname, a.attnum
+"""
+
+_PG_PRIMARY_KEYS = """
+SELECT c.relname, a.attname
+FROM pg_catalog.pg_index AS i
+JOIN pg_catalog.pg_class AS c ON c.oid = i.indrelid
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_attribute AS a ON a.attrelid = c.oid AND a.attnum = ANY(i.indkey)
+WHERE i.indisprimary AND n.nspname = %s AND c.relname = ANY(%s)
+ORDER BY c.relname, a.attnum
+"""
+
+_PG_FOREIGN_KEYS = """
+SELECT c.relname, a.attname, fc.relname, fa.attname
+FROM pg_catalog.pg_constraint AS con
+JOIN pg_catalog.pg_class AS c ON c.oid = con.conrelid
+JOIN pg_catalog.pg_namespace AS n ON n.oid = c.relnamespace
+JOIN pg_catalog.pg_class AS fc ON fc.oid = con.confrelid
+JOIN pg_catalog.pg_attribute AS a ON a.attrelid = con.conrelid AND a.attnum = con.conkey[1]
+JOIN pg_catalog.pg_attribute AS fa ON fa.attrelid = con.confrelid AND fa.attnum = con.confkey[1]
+WHERE con.contype = 'f' AND n.nspname = %s AND c.relname = ANY(%s)
+ORDER BY c.relname, a.attname
+"""
+
+_PG_INDEXES = """
+SELECT t.relname, i.relname, idxs.indexdef, idx.indisunique, array_to_string(array_agg(cols.attname), ',')
+FROM pg_catalog.pg_class AS t
+JOIN pg_catalog.pg_index AS idx ON t.oid = idx.indrelid
+JOIN pg_catalog.pg_class AS i ON idx.indexrelid = i.oid
+JOIN pg_catalog.pg_indexes AS idxs ON idxs.tablename = t.relname AND idxs.indexname = i.relname
+LEFT OUTER JOIN pg_catalog.pg_attribute AS cols ON cols.attrelid = t.oid AND cols.attnum = ANY(idx.indkey)
+WHERE t.relname = ANY(%s) AND t.relkind = 'r' AND idxs.schemaname = %s
+GROUP BY t.relname, i.relname, idxs.indexdef, idx.indisunique
+ORDER BY t.relname, idx.indisunique DESC, i.relname
+"""
+
+
+def _md5(rows):
+    digest = hashlib.md5()
+    for row in rows:
+        digest.update(json.dumps([six.text_type(value) for value in row]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def schema_fingerprint(database, schema=None):
+    """
+    Отпечаток схемы: хеш описаний столбцов, ограничений и индексов, вычисляемый одним-тремя запросами к каталогу
+    """
+    if isinstance(database, PostgresqlDatabase):
+        schema = schema or 'public'
+        row = database.execute_sql(_PG_FINGERPRINT, (schema, schema, schema)).fetchone()
+        fingerprint = _md5([row])
+    elif isinstance(database, MySQLDatabase):
+        fingerprint = _md5(
+            row for query in _MYSQL_FINGERPRINT for row in database.execute_sql(query).fetchall()
+        )
+    else:
+        fingerprint = _md5(database.execute_sql(
+            'SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name'
+        ).fetchall())
+    return '{}:{}'.format(CACHE_VERSION, fingerprint)
+
+
+def _field_classes():
+    """
+    Классы полей по имени, для восстановления столбцов из кеша
+    """
+    classes = {}
+    modules = [peewee] + ([postgres_ext] if postgres_ext is not None else [])
+    for module in modules:
+        for name in dir(module):
+            obj = getattr(module, name)
+            if isinstance(obj, type) and issubclass(obj, peewee.Field):
+                classes.setdefault(name, obj)
+    return classes
+
+
+class _CachedMetadata(object):
+    """
+    Замена playhouse.reflection.Metadata: столбцы, ключи и индексы берутся из прочитанного заранее описания таблиц
+    """
+    requires_extension = False
+
+    def __init__(self, database, tables):
+        self.database = database
+        self.tables = tables
+        self.field_classes = _field_classes()
+
+    def get_columns(self, table, schema=None):
+        columns = []
+        for name, data_type, nullable, primary_key, field_class in self.tables[table]['columns']:
+            columns.append((name, Column(
+                name, field_class=self.field_classes.get(field_class, UnknownField), raw_column_type=data_type,
+                nullable=nullable, primary_key=primary_key, db_column=name
+            )))
+        return OrderedDict(columns)
+
+    def get_foreign_keys(self, table, schema=None):
+        return [
+            peewee.ForeignKeyMetadata(column, dest_table, dest_column, table)
+            for column, dest_table, dest_column in self.tables[table]['foreign_keys']
+        ]
+
+    def get_primary_keys(self, table, schema=None):
+        return list(self.tables[table]['primary_keys'])
+
+    def get_indexes(self, table, schema=None):
+        return [
+            peewee.IndexMetadata(name, sql, columns, unique, table)
+            for name, sql, columns, unique in self.tables[table]['indexes']
+        ]
+
+
+class SchemaReflector(object):
+    """
+    Модели peewee для выбранных таблиц базы данных. Таблицы, на которые ссылаются внешние ключи выбранных,
+    читаются тоже. Если задан cache_path, описание таблиц хранится в файле до изменения отпечатка схемы.
+    """
+
+    def __init__(self, database, schema=None, cache_path=None):
+        self.database = database
+        self.schema = schema
+        self.cache_path = cache_path
+
+    def get_tables(self):
+        if self.schema:
+            return self.database.get_tables(schema=self.schema)
+        return self.database.get_tables()
+
+    def read_cache(self):
+        try:
+            with codecs.open(self.cache_path, 'r', 'utf-8') as f:
+                return json.loads(f.read())
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def write_cache(self, cache):
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with codecs.open(self.cache_path, 'w', 'utf-8') as f:
+            f.write(json.dumps(cache, sort_keys=True))
+
+    def reflect(self, table_names=None):
+        """
+        Описание таблиц (вместе с замыканием по внешним ключам) в виде, пригодном для JSON
+        """
+        if self.cache_path is None:
+            return self.fetch(table_names)
+        fingerprint = schema_fingerprint(self.database, self.schema)
+        cache = self.read_cache()
+        if cache.get('fingerprint') != fingerprint:
+            cache = {'fingerprint': fingerprint, 'tables': {}}
+        tables = cache['tables']
+        changed = False
+        result = {}
+        # Замыкание по внешним ключам уровнями: отсутствующие в кеше таблицы уровня читаются одним запросом
+        pending = set(self.get_tables()) if table_names is None else set(table_names)
+        while pending:
+            missing = sorted(table for table in pending if table not in tables)
+            if missing:
+                tables.update(self.fetch(missing))
+                changed = True
+            added = [table for table in pending if table in tables]
+            result.update((table, tables[table]) for table in added)
+            pending = set(
+                dest_table for table in added for column, dest_table, dest_column in tables[table]['foreign_keys']
+                if dest_table not in result
+            )
+        if changed:
+            self.write_cache(cache)
+        return result
+
+    def fetch(self, table_names=None):
+        """
+        Чтение описания таблиц из каталога базы данных
+        """
+        existing = self.get_tables()
+        if table_names is not None:
+            existing_set = set(existing)
+            existing = sorted(set(table for table in table_names if table in existing_set))
+        result = {}
+        pending = existing
+        while pending:
+            if isinstance(self.database, PostgresqlDatabase):
+                result.update(self._fetch_postgres(pending))
+            else:
+                result.update(self._fetch_tables(pending))
+            pending = sorted(set(
+                dest_table for table in result.values() for column, dest_table, dest_column in table['foreign_keys']
+                if dest_table not in result
+            ))
+        return result
+
+    def _fetch_tables(self, table_names):
+        """
+        Запросы по каждой таблице через playhouse.reflection
+        """
+        metadata = Introspector.from_database(self.database, schema=self.schema).metadata
+        result = {}
+        for table in table_names:
+            columns = metadata.get_columns(table, self.schema)
+            result[table] = {
+                'columns': [
+                    [name, column.raw_column_type, column.nullable, column.primary_key, column.field_class.__name__]
+                    for name, column in columns.items()
+                ],
+                'primary_keys': list(metadata.get_primary_keys(table, self.schema)),
+                'foreign_keys': [
+                    [fk.column, fk.dest_table, fk.dest_column] for fk in metadata.get_foreign_keys(table, self.schema)
+                ],
+                'indexes': [
+                    [index.name, index.sql, list(index.columns), index.unique]
+                    for index in metadata.get_indexes(table, self.schema)
+                ],
+            }
+        return result
+
+    def _fetch_postgres(self, table_names):
+        """
+        Четыре запроса к каталогу PostgreSQL на весь набор таблиц
+        """
+        metadata = Introspector.from_database(self.database, schema=self.schema).metadata
+        schema = self.schema or 'public'
+        tables = list(table_names)
+        result = {
+            table: {'columns': [], 'primary_keys': [], 'foreign_keys': [], 'indexes': []} for table in tables
+        }
+        for table, column in self.database.execute_sql(_PG_PRIMARY_KEYS, (schema, tables)).fetchall():
+            result[table]['primary_keys'].append(column)
+        columns = self.database.execute_sql(_PG_COLUMNS, (schema, tables)).fetchall()
+        for table, name, data_type, nullable, type_oid in columns:
+            primary_keys = result[table]['primary_keys']
+            field_class = metadata.column_map.get(type_oid, UnknownField)
+            if primary_keys == [name] and field_class is IntegerField:
+                field_class = PrimaryKeyField
+            result[table]['columns'].append([name, data_type, nullable, name in primary_keys, field_class.__name__])
+        foreign_keys = self.database.execute_sql(_PG_FOREIGN_KEYS, (schema, tables)).fetchall()
+        for table, column, dest_table, dest_column in foreign_keys:
+            result[table]['foreign_keys'].append([column, dest_table, dest_column])
+        for table, name, sql, unique, columns in self.database.execute_sql(_PG_INDEXES, (tables, schema)).fetchall():
+            result[table]['indexes'].append([name, sql, columns.split(','), unique])
+        return result
+
+    def generate_models(self, table_names=None):
+        """
+        Модели peewee по таблицам: {имя таблицы: модель}
+        """
+        tables = self.reflect(table_names)
+        introspector = Introspector(_CachedMetadata(self.database, tables), schema=self.schema)
+        return introspector.generate_models(table_names=list(tables))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import codecs
+import datetime
+import json
+import os
+
+import peewee
+
+__all__ = ['FileStateBackend', 'DatabaseStateBackend']
+
+
+class FileStateBackend(object):
+    """
+    Список примененных миграций в файле .applied.json в директории миграций
+    """
+    FILE_NAME = '.applied.json'
+    # Запись не участвует в транзакции базы данных
+    transactional = False
+    # Служебные таблицы в базе данных
+    tables = ()
+
+    def __init__(self, config):
+        self.config = config
+
+    @property
+    def path(self):
+        return os.path.join(self.config.get_setting(self.config.MIGRATOR_MIGRATIONS_DIR), self.FILE_NAME)
+
+    def get_applied(self):
+        try:
+            with codecs.open(self.path, 'r', 'utf-8') as f:
+                return json.loads(f.read())
+        except:
+            return []
+
+    def save(self, applied):
+        with codecs.open(self.path, 'w', 'utf-8') as f:
+            f.write(json.dumps(list(applied)))
+
+    def add(self, revision, duration=None, checksum=None):
+        self.add_many([(revision, checksum)])
+
+    def add_many(self, revisions):
+        applied = set(self.get_applied())
+        applied.update(revision for revision, checksum in revisions)
+        self.save(applied)
+
+    def remove(self, revision):
+        applied = set(self.get_applied())
+        applied.discard(revision)
+        self.save(applied)
+
+
+class DatabaseStateBackend(object):
+    """
+    Таблица примененных миграций в базе данных. Подходит для случая, когда с одной базой работает
+    несколько копий проекта.
+    """
+    DEFAULT_TABLE = 'migrator_history'
+    transactional = True
+
+    def __init__(self, config):
+        self.config = config
+        self.db = config.get_db()
+        self.model = self.make_model(
+            self.db, config.get_setting(config.MIGRATOR_STATE_TABLE, self.DEFAULT_TABLE) or self.DEFAULT_TABLE
+        )
+        self._table_checked = False
+
+    @staticmethod
+    def make_model(db, db_table):
+        class MigrationHistory(peewee.Model):
+            revision = peewee.CharField(max_length=64, primary_key=True)
+            applied_at = peewee.DateTimeField(default=datetime.datetime.now)
+            duration = peewee.FloatField(null=True)
+            checksum = peewee.CharField(max_length=32, null=True)
+
+            class Meta:
+                database = db
+
+        MigrationHistory._meta.db_table = db_table
+        return MigrationHistory
+
+    @property
+    def tables(self):
+        """
+        Служебные таблицы: не выгружаются в фикстуры и не попадают в модели миграций
+        """
+        return (self.model._meta.db_table,)
+
+    def ensure_table(self):
+        if not self._table_checked:
+            self.model.create_table(fail_silently=True)
+            self._table_checked = True
+
+    def get_applied(self):
+        self.ensure_table()
+        return [revision for revision, in self.model.select(self.model.revision).tuples()]
+
+    def add(self, revision, duration=None, checksum=None):
+        self.ensure_table()
+        with self.db.atomic():
+            self.model.delete().where(self.model.revision == revision).execute()
+            self.model.insert(revision=revision, duration=duration, checksum=checksum).execute()
+
+    def add_many(self, revisions):
+        """
+        Пометка множества миграций примененными (fake) многострочными INSERT
+        """
+        self.ensure_table()
+        applied = set(self.get_applied())
+        now = datetime.datetime.now()
+        rows = [
+            {'revision': revision, 'checksum': checksum, 'applied_at': now}
+            for revision, checksum in revisions if revision not in applied
+        ]
+        batch_size = max(1, self.config.max_query_params // len(self.model._meta.fields))
+        with self.db.atomic():
+            for i in range(0, len(rows), batch_size):
+                self.model.insert_many(rows[i:i + batch_size]).execute()
+
+    def remove(self, revision):
+        self.ensure_table()
+        self.model.delete().where(self.model.revision == revision).execute()
@@ -1,26 +1,126 @@
 # -*- coding: utf-8 -*-
 import base64
+import datetime
+import decimal
 import json
 import pickle
+import uuid
 
+import peewee
+import six
+
+# Значение с типом, который не представим в JSON: {"__type__": "datetime", "value": "2017-01-01 00:00:00"}
+TYPE_TAG = '__type__'
+# Значение, сериализованное через pickle: {"__pickled_object__": "<base64>"}
+PICKLE_TAG = '__pickled_object__'
+
+
+def _encode_bytes(value):
+    if isinstance(value, memoryview):
+        value = value.tobytes()
+    return base64.b64encode(bytes(value)).decode('ascii')
+
+
+# Тег, типы python, кодирование в строку, декодирование из строки.
+# datetime идет раньше date, так как является его подклассом.
+TAGGED_TYPES = (
+    ('datetime', (datetime.datetime,), six.text_type, peewee.DateTimeField().python_value),
+    ('date', (datetime.date,), six.text_type, peewee.DateField().python_value),
+    ('time', (datetime.time,), six.text_type, peewee.TimeField().python_value),
+    ('decimal', (decimal.Decimal,), six.text_type, decimal.Decimal),
+    ('uuid', (uuid.UUID,), six.text_type, uuid.UUID),
+    ('bytes', (six.binary_type, bytearray, memoryview), _encode_bytes, base64.b64decode),
+)
+TAG_DECODERS = {tag: decode for tag, types, encode, decode in TAGGED_TYPES}
+
+# Поля моделей, значения которых пишутся простой строкой без тега: тип поля известен при загрузке
+FIELD_TYPES = (
+    (peewee.DateTimeField, (datetime.datetime, datetime.date)),
+    (peewee.DateField, (datetime.date,)),
+    (peewee.TimeField, (datetime.time,)),
+    (peewee.DecimalField, (decimal.Decimal,)),
+    (peewee.UUIDField, (uuid.UUID,)),
+)
+
+
+class TaggedEncoder(json.JSONEncoder):
+    """
+    Кодирование datetime, date, time, Decimal, UUID и bytes в виде {"__type__": ..., "value": ...}.
+    Остальные типы сериализуются через pickle, только если это явно разрешено allow_pickle.
+    """
+    allow_pickle = False
 
-class SafeEncoder(json.JSONEncoder):
     def default(self, obj):
-        try:
-            return super(SafeEncoder, self).default(self, obj)
-        except TypeError:
-            try:
-                if isinstance(obj, memoryview):
-                    obj = bytes(obj)
-                return {'__pickled_object__': base64.b64encode(pickle.dumps(obj)).decode()}
-            except:
-                return '__unencoded_object__'
+        for tag, types, encode, decode in TAGGED_TYPES:
+            if isinstance(obj, types):
+                return {TYPE_TAG: tag, 'value': encode(obj)}
+        if self.allow_pickle:
+            return {PICKLE_TAG: base64.b64encode(pickle.dumps(obj)).decode()}
+        return super(TaggedEncoder, self).default(obj)
+
+
+class PickleFallbackEncoder(TaggedEncoder):
+    allow_pickle = True
+
+
+def tagged_hook(dct):
+    """
+    Декодирование значений с тегом. Значение, сериализованное через pickle, - ошибка: распаковка pickle
+    выполняет произвольный код и возможна только явно, через pickle_tagged_hook.
+    """
+    if TYPE_TAG in dct and len(dct) == 2:
+        decode = TAG_DECODERS.get(dct[TYPE_TAG])
+        if decode is not None:
+            return decode(dct['value'])
+    if PICKLE_TAG in dct:
+        raise Exception('Fixture contains pickled values, loading them requires allow_pickle')
+    return dct
+
+
+def pickle_tagged_hook(dct):
+    """
+    tagged_hook с распаковкой pickle, только для доверенных фикстур
+    """
+    if PICKLE_TAG in dct:
+        return pickle_hook(dct)
+    return tagged_hook(dct)
+
+
+class RowCodec(object):
+    """
+    Кодирование строк модели с учетом типов полей: значения дат, Decimal и UUID хранятся строками
+    без тега и приводятся к типу поля при загрузке. Кодировщики выбираются один раз для модели.
+    """
+
+    def __init__(self, model_class):
+        self.encoders = []
+        self.decoders = []
+        for field in model_class._meta.sorted_fields:
+            for field_class, types in FIELD_TYPES:
+                if isinstance(field, field_class):
+                    self.encoders.append((field.name, types))
+                    self.decoders.append((field.name, field.python_value))
+                    break
+
+    def encode(self, row):
+        for name, types in self.encoders:
+            value = row.get(name)
+            if isinstance(value, types):
+                row[name] = six.text_type(value)
+        return row
+
+    def decode(self, row):
+        for name, python_value in self.decoders:
+            value = row.get(name)
+            if isinstance(value, six.string_types):
+                row[name] = python_value(value)
+        return row
 
 
 def pickle_hook(dct):
-    if '__pickled_object__' in dct:
+    if PICKLE_TAG in dct:
         try:
-            return pickle.loads(base64.b64decode(dct['__pickled_object__']))
+            return pickle.loads(base64.b64decode(dct[PICKLE_TAG]))
         except:
             return '__unencoded_object__'
-    return dct
\ No newline at end of file
+    return dct
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+from migrator.collector import ChangesCollector
+from migrator.executor import Executor
+from tests.test_migration_code import BaseTestCase
+
+
+def make_schema(tables_count, fields_count, prefix='Model', extra_field=None):
+    """
+    Описание моделей в виде CodeGenerator.clses_json(): {имя модели: модель}
+    """
+    schema = {}
+    for i in range(tables_count):
+        fields = [{'name': 'id', 'path': 'peewee.PrimaryKeyField', 'params': {}}]
+        for j in range(fields_count):
+            params = {'null': True} if (i + j) % 3 == 0 else {}
+            if j % 4 == 0:
+                params['db_field'] = 'column_{}'.format(j)
+            fields.append({'name': 'field_{}'.format(j), 'path': 'peewee.CharField', 'params': params})
+        if extra_field is not None and i % 2 == 0:
+            fields.append({'name': extra_field, 'path': 'peewee.TextField', 'params': {'index': True}})
+        name = '{}{}'.format(prefix, i)
+        schema[name] = {'name': name, 'table': 'table_{}'.format(i), 'fields': fields}
+    return schema
+
+
+class CountingDict(dict):
+    """
+    Словарь, считающий перебранные элементы
+    """
+    iterated = 0
+
+    def items(self):
+        for item in super(CountingDict, self).items():
+            self.iterated += 1
+            yield item
+
+    def keys(self):
+        for key in super(CountingDict, self).keys():
+            self.iterated += 1
+            yield key
+
+    def __iter__(self):
+        return iter(self.keys())
+
+
+class ChangesCollectorTest(BaseTestCase):
+
+    def test_table_matches(self):
+        new = {
+            'Same': {'table': 'same'}, 'Renamed': {'table': 'old_table'}, 'Created': {'table': 'created'},
+        }
+        old = {'Same': {'table': 'other'}, 'First': {'table': 'old_table'}, 'Second': {'table': 'old_table'}}
+        # Совпадение по имени модели важнее совпадения по таблице, из нескольких по таблице - последнее
+        self.assertEqual(ChangesCollector.get_table_matches(new, old), {'Same': 'Same', 'Renamed': 'Second'})
+
+    def test_field_matches(self):
+        new_ordered = [
+            {'name': 'a', 'params': {}},
+            {'name': 'b', 'params': {'db_field': 'x'}},
+            {'name': 'c', 'params': {}},
+        ]
+        old_fields = {
+            'a': {'name': 'a', 'params': {'db_field': 'other'}},
+            'x': {'name': 'x', 'params': {}},
+            'y': {'name': 'y', 'params': {'db_field': 'x'}},
+            'z': {'name': 'z', 'params': {'db_field': 'c'}},
+        }
+        new_fields = {x['name']: x for x in new_ordered}
+        # Совпадение по db_field переопределяет совпадение по имени, из нескольких - последнее
+        self.assertEqual(
+            ChangesCollector.get_field_matches(new_ordered, new_fields, old_fields), {'a': 'a', 'b': 'y', 'c': 'z'}
+        )
+
+    def test_linear(self):
+        # Модели переименованы (совпадение только по таблице), у половины добавлено поле
+        old = CountingDict(make_schema(5000, 12, prefix='Old'))
+        new = make_schema(5000, 12, prefix='New', extra_field='added')
+        fields_count = sum(len(x['fields']) for x in new.values())
+        calls = []
+        get_db_field = ChangesCollector.__dict__['get_db_field']
+
+        def counting_get_db_field(cls, field):
+            calls.append(field)
+            return get_db_field.__func__(cls, field)
+
+        ChangesCollector.get_db_field = classmethod(counting_get_db_field)
+        try:
+            migration = Executor(self.get_config())._get_migration_changes(new=new, old=old)
+        finally:
+            ChangesCollector.get_db_field = get_db_field
+
+        self.assertEqual(migration['create'], [])
+        self.assertEqual(migration['drop'], [])
+        self.assertEqual(len(migration['fields']['create']), 2500)
+        self.assertEqual(migration['fields']['drop'], [])
+        self.assertEqual(len(migration['fields']['index']), 0)
+        self.assertEqual(migration['fields']['create'][0][1], 'added')
+        # Число операций растет линейно: старые модели перебираются один раз, каждое поле - считанное число раз
+        self.assertLessEqual(old.iterated, 2 * len(old))
+        self.assertLessEqual(len(calls), 4 * fields_count)
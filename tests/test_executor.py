@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import codecs
+import hashlib
+import json
+import os
+import sys
+
+from migrator.code_generator import CodeGenerator
+from migrator.config import TargetError
+from migrator.executor import Executor
+from migrator.fanout import FanOut, TargetResult
+from migrator.manifest import Manifest, read_header
+from migrator.planner import Planner, PlanError
+from migrator.state import DatabaseStateBackend
+from tests.test_migration_code import BaseTestCase
+
+
+class ExecutorTestCase(BaseTestCase):
+    def setUp(self):
+        super(ExecutorTestCase, self).setUp()
+        self.migrations_dir = os.path.join(self.dirpath, self.MIGRATIONS_DIR_NAME)
+
+    def tearDown(self):
+        # Модули миграций с тем же хешем в других тестах должны импортироваться заново
+        for name in [x for x in sys.modules if x.startswith('migration_')]:
+            del sys.modules[name]
+        super(ExecutorTestCase, self).tearDown()
+
+    def write_migration(self, migration_time, dependencies=None, up=None, name=None):
+        migration_hash = hashlib.md5(str(migration_time).encode('utf-8')).hexdigest()
+        code = CodeGenerator.migration_code(
+            ['import peewee'], [], up=up, migration_name=name or 'test {}'.format(migration_time),
+            dependencies=[{'hash': x} for x in (dependencies or [])],
+            migration_time=migration_time, migration_hash=migration_hash
+        )
+        with codecs.open(os.path.join(self.migrations_dir, 'migration_{}.py'.format(migration_hash)), 'w', 'utf-8') as f:
+            f.write(code)
+        return migration_hash
+
+
+class HeaderTest(ExecutorTestCase):
+    def test_generated_header(self):
+        first = self.write_migration(1000)
+        second = self.write_migration(2000, dependencies=[first], name='Миграция')
+        header = read_header(os.path.join(self.migrations_dir, Manifest.file_name(second)))
+        self.assertEqual(header, {'name': 'Миграция', 'time': 2000, 'dependencies': [first]})
+
+        list(Executor(self.get_config()).get_migrations())
+        self.assertNotIn('migration_{}'.format(second), sys.modules)
+
+    def test_hand_written_header(self):
+        path = os.path.join(self.migrations_dir, Manifest.file_name('manual'))
+        with codecs.open(path, 'w', 'utf-8') as f:
+            f.write(
+                'MIGRATION_NAME = "manual"\n'
+                'MIGRATION_TIME = 10 * 100\n'
+                'MIGRATION_DEPENDENCIES = []\n'
+            )
+        self.assertIsNone(read_header(path))
+        self.assertEqual(Executor(self.get_config()).fetch_migration('manual')['time'], 1000)
+
+
+class ManifestTest(ExecutorTestCase):
+    def test_list_without_import(self):
+        first = self.write_migration(1000)
+        second = self.write_migration(2000, dependencies=[first])
+        executor = Executor(self.get_config())
+        migrations = {x['hash']: x for x in executor.get_migrations()}
+
+        self.assertEqual(set(migrations), {first, second})
+        self.assertEqual(migrations[second]['dependencies'], [first])
+        self.assertEqual(migrations[first]['time'], 1000)
+        with codecs.open(os.path.join(self.migrations_dir, Manifest.FILE_NAME), 'r', 'utf-8') as f:
+            self.assertEqual(set(json.loads(f.read())['migrations']), {first, second})
+
+        # Повторное чтение обходится без загрузки заголовков
+        loaded = []
+        manifest = Manifest(self.migrations_dir, header_loader=lambda *args: loaded.append(args))
+        self.assertEqual(set(manifest.entries()), {first, second})
+        self.assertEqual(loaded, [])
+
+    def test_changed_file_is_reread(self):
+        first = self.write_migration(1000)
+        Executor(self.get_config()).manifest.entries()
+        path = os.path.join(self.migrations_dir, Manifest.file_name(first))
+        with codecs.open(path, 'r', 'utf-8') as f:
+            code = f.read()
+        with codecs.open(path, 'w', 'utf-8') as f:
+            f.write(code.replace("MIGRATION_NAME = 'test 1000'", "MIGRATION_NAME = 'renamed'"))
+        sys.modules.pop('migration_{}'.format(first), None)
+
+        migration = Executor(self.get_config()).fetch_migration(first)
+        self.assertEqual(migration['name'], 'renamed')
+
+    def test_make_migration_updates_manifest(self):
+        self.write_models([
+            'class Message(peewee.Model):',
+            '<tab>',
+            'key = peewee.CharField(max_length=64)',
+        ])
+        executor = Executor(self.get_config())
+        path = executor.make_empty_migration(migration_name='empty')
+        revision = Manifest.revision_by_file(os.path.basename(path))
+
+        manifest = Manifest(self.migrations_dir, header_loader=None)
+        self.assertEqual(manifest.get(revision)['name'], 'empty')
+        self.assertEqual(manifest.get(revision)['checksum'], Manifest.checksum(path))
+
+    def test_add_to_cold_manifest(self):
+        first = self.write_migration(1100)
+        Executor(self.get_config()).manifest.entries()
+        second = self.write_migration(1200, dependencies=[first])
+        loaded = []
+        manifest = Manifest(self.migrations_dir, header_loader=lambda *args: loaded.append(args))
+        manifest.add(second, name='test 1200', time=1200, dependencies=[first])
+        # Директория не перечитывается, заголовки не загружаются
+        self.assertIsNone(manifest._entries)
+        self.assertEqual(set(manifest.entries()), {first, second})
+        self.assertEqual(manifest.get(second)['dependencies'], [first])
+        self.assertEqual(loaded, [])
+
+    def test_prefix_lookup(self):
+        manifest = Manifest(self.migrations_dir, header_loader=None)
+        manifest._entries = {rev: {} for rev in ('abc1', 'abc2', 'abd0', 'b000')}
+        self.assertEqual(manifest.find('ab'), ['abc1', 'abc2', 'abd0'])
+        self.assertEqual(manifest.find('abc2'), ['abc2'])
+        self.assertEqual(manifest.find('abe'), [])
+        self.assertEqual(manifest.find(''), ['abc1', 'abc2', 'abd0', 'b000'])
+
+        first = self.write_migration(6000)
+        executor = Executor(self.get_config())
+        self.assertEqual([x['hash'] for x in executor.get_migrations_by_hash(first[:6])], [first])
+
+
+class SchemaSnapshotTest(ExecutorTestCase):
+    def make_models(self, *fields):
+        self.write_models(
+            ['class Message(peewee.Model):', '<tab>', 'key = peewee.CharField(max_length=64)'] + list(fields)
+        )
+
+    def make_executor(self, migration_time):
+        """
+        Executor, создающий миграции с заданным временем (и хешем)
+        """
+        executor = Executor(self.get_config())
+        make_migration = executor.make_migration
+        executor.make_migration = lambda *args, **kwargs: make_migration(*args, migration_time=migration_time, **kwargs)
+        return executor
+
+    def make_first(self, migration_time):
+        executor = self.make_executor(migration_time)
+        path = executor.make_empty_migration(migration_name='first')
+        return executor, Manifest.revision_by_file(os.path.basename(path))
+
+    def from_last(self, revision, migration_time):
+        executor = self.make_executor(migration_time)
+        path = executor.migrate_from_migration(executor.fetch_migration(revision), migration_name='next')
+        with codecs.open(path, 'r', 'utf-8') as f:
+            return f.read()
+
+    def test_diff_from_snapshot(self):
+        self.make_models()
+        executor, revision = self.make_first(7100)
+        with codecs.open(executor.get_schema_snapshot_path(revision), 'r', 'utf-8') as f:
+            snapshot = json.loads(f.read())
+        self.assertEqual([x['name'] for x in snapshot['schema']], ['Message'])
+        self.assertEqual(snapshot['models'][0][:2], ['Message', 'message'])
+
+        self.make_models('text = peewee.TextField(null=True)')
+        sys.modules.pop('migration_{}'.format(revision), None)
+        code = self.from_last(revision, 7101)
+        # Предыдущее состояние прочитано из снимка, модуль миграции не импортировался
+        self.assertNotIn('migration_{}'.format(revision), sys.modules)
+        self.assertIn("migrator.add_column('message', 'text', Message.text)", code)
+        self.assertIn("migrator.drop_column('message', 'text')", code)
+
+    def test_fallback_to_import(self):
+        self.make_models()
+        executor, revision = self.make_first(7200)
+        os.remove(executor.get_schema_snapshot_path(revision))
+
+        self.make_models('text = peewee.TextField(null=True)')
+        code = self.from_last(revision, 7201)
+        self.assertIn("migrator.add_column('message', 'text', Message.text)", code)
+
+
+class StateSnapshotTest(ExecutorTestCase):
+    def test_state_read_once(self):
+        first = self.write_migration(4000)
+        second = self.write_migration(4001, dependencies=[first])
+        executor = Executor(self.get_config())
+        executor.make_required(second)
+        reads = []
+        get_applied = executor.state.get_applied
+        executor.state.get_applied = lambda: reads.append(1) or get_applied()
+
+        migrations = {x['hash']: x for x in executor.get_migrations()}
+        self.assertEqual(migrations[second]['required'], 0)
+        self.assertIsNone(migrations[first]['required'])
+        self.assertFalse(executor.check_dependencies(migrations[second]))
+        self.assertEqual(len(reads), 1)
+
+        executor.apply(migrations[first], fake=True)
+        self.assertTrue(executor.check_dependencies(migrations[second]))
+
+
+class DatabaseStateMixin(object):
+    def get_config(self):
+        cfg = super(DatabaseStateMixin, self).get_config()
+        cfg[cfg.BASE_SECTION][cfg.MIGRATOR_STATE_BACKEND] = 'db'
+        return cfg
+
+
+class DatabaseStateTest(DatabaseStateMixin, ExecutorTestCase):
+
+    def test_apply_and_revert(self):
+        first = self.write_migration(3000)
+        executor = Executor(self.get_config())
+        self.assertIsInstance(executor.state, DatabaseStateBackend)
+
+        executor.apply(executor.fetch_migration(first))
+        self.assertEqual(executor.check_status(first), executor.STATUS_APPLIED)
+        row = executor.state.model.get()
+        self.assertEqual(row.checksum, executor.get_checksum(first))
+        self.assertIsNotNone(row.duration)
+        self.assertFalse(os.path.exists(os.path.join(self.migrations_dir, '.applied.json')))
+
+        executor.revert(executor.fetch_migration(first))
+        self.assertEqual(Executor(self.get_config()).get_applied(), [])
+
+    def test_fake_apply_many(self):
+        executor = Executor(self.get_config())
+        executor.state.add('rev_0')
+        executor.state.add_many([('rev_{}'.format(i), None) for i in range(2500)])
+        self.assertEqual(len(set(executor.get_applied())), 2500)
+
+
+class PlannerTest(ExecutorTestCase):
+    @staticmethod
+    def planner(graph):
+        return Planner([
+            {'hash': rev, 'time': i, 'dependencies': deps} for i, (rev, deps) in enumerate(sorted(graph.items()))
+        ])
+
+    def test_order(self):
+        planner = self.planner({'a': [], 'b': ['a'], 'c': ['a'], 'd': ['c', 'b'], 'e': []})
+        self.assertEqual([x['hash'] for x in planner.plan(['d', 'e'], applied=[])], ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual([x['hash'] for x in planner.plan(['e', 'd'], applied=['b'])], ['e', 'a', 'c', 'd'])
+        self.assertEqual(planner.plan(['d'], applied=['a', 'b', 'c', 'd']), [])
+
+    def test_invalid_graph(self):
+        with self.assertRaises(PlanError):
+            self.planner({'a': ['b'], 'b': ['c'], 'c': ['a']}).plan(['a'], applied=[])
+        with self.assertRaises(PlanError):
+            self.planner({'a': ['x']}).plan(['a'], applied=[])
+        self.assertEqual(len(self.planner({'a': ['x']}).plan(['a'], applied=['x'])), 1)
+
+    def test_validate_targets_only(self):
+        # Ошибки в миграциях, не нужных для целей, не мешают плану
+        planner = self.planner({'a': [], 'b': ['a'], 'c': ['x'], 'd': ['e'], 'e': ['d']})
+        self.assertEqual([x['hash'] for x in planner.plan(['b'], applied=[])], ['a', 'b'])
+        with self.assertRaises(PlanError):
+            planner.plan(['c'], applied=[])
+        with self.assertRaises(PlanError):
+            planner.plan(['b', 'd'], applied=[])
+
+    def test_apply_plan(self):
+        first = self.write_migration(5000)
+        second = self.write_migration(5001, dependencies=[first])
+        executor = Executor(self.get_config())
+        executor.make_required(second)
+        applied = []
+        executor.apply_plan(executor.plan(), fake=True, callback=lambda x: applied.append(x['hash']))
+        self.assertEqual(applied, [first, second])
+        self.assertEqual(Executor(self.get_config()).plan(), [])
+
+
+class SharedConnectionTest(DatabaseStateMixin, ExecutorTestCase):
+    def test_one_connection_per_run(self):
+        revisions = [self.write_migration(7000 + i, up=["proxy_db.execute_sql('SELECT 1')"]) for i in range(3)]
+        config = self.get_config()
+        db = config.get_db()
+        self.assertIs(config.get_migrator().database, db)
+        connects = []
+        _connect = db._connect
+        db._connect = lambda *args, **kwargs: connects.append(1) or _connect(*args, **kwargs)
+
+        executor = Executor(config)
+        executor.apply_plan(executor.plan(revisions))
+        self.assertEqual(len(executor.get_applied()), 3)
+        self.assertEqual(len(connects), 1)
+
+        config.close_db()
+        self.assertTrue(db.is_closed())
+
+
+class TransactionTest(DatabaseStateMixin, ExecutorTestCase):
+    def create_table_migration(self, migration_time, table, fail=False):
+        up = ["proxy_db.execute_sql('CREATE TABLE {} (id INTEGER)')".format(table)]
+        if fail:
+            up.append("raise ValueError('boom')")
+        return self.write_migration(migration_time, up=up)
+
+    def test_migration_rollback(self):
+        revision = self.create_table_migration(8000, 'tx_one', fail=True)
+        executor = Executor(self.get_config())
+        with self.assertRaises(ValueError):
+            executor.apply(executor.fetch_migration(revision), transaction=executor.TRANSACTION_MIGRATION)
+        self.assertNotIn('tx_one', executor.get_db_obj().get_tables())
+        self.assertEqual(executor.get_applied(), [])
+
+    def test_batch_rollback(self):
+        revisions = [
+            self.create_table_migration(8100, 'tx_first'),
+            self.create_table_migration(8101, 'tx_second'),
+            self.create_table_migration(8102, 'tx_third', fail=True),
+        ]
+        executor = Executor(self.get_config())
+        with self.assertRaises(ValueError):
+            executor.apply_plan(executor.plan(revisions), transaction=executor.TRANSACTION_BATCH)
+        self.assertFalse({'tx_first', 'tx_second'} & set(executor.get_db_obj().get_tables()))
+        self.assertEqual(executor.get_applied(), [])
+
+    def test_non_atomic_migration_splits_batch(self):
+        revisions = [
+            self.create_table_migration(8200, 'tx_first'),
+            self.create_table_migration(8201, 'tx_second', fail=True),
+        ]
+        with codecs.open(os.path.join(self.migrations_dir, Manifest.file_name(revisions[1])), 'a', 'utf-8') as f:
+            f.write('\nMIGRATION_ATOMIC = False\n')
+        executor = Executor(self.get_config())
+        with self.assertRaises(ValueError):
+            executor.apply_plan(executor.plan(revisions), transaction=executor.TRANSACTION_BATCH)
+        self.assertIn('tx_first', executor.get_db_obj().get_tables())
+        self.assertIn('tx_second', executor.get_db_obj().get_tables())
+        self.assertEqual(executor.get_applied(), [revisions[0]])
+
+
+class FanOutTest(DatabaseStateMixin, ExecutorTestCase):
+    def setUp(self):
+        super(FanOutTest, self).setUp()
+        self.shards_dir = os.path.join(self.dirpath, 'shards')
+        os.mkdir(self.shards_dir)
+
+    def shard_url(self, name):
+        return 'sqlite:///{}'.format(os.path.join(self.shards_dir, '{}.db'.format(name)))
+
+    def get_config(self, targets=()):
+        cfg = super(FanOutTest, self).get_config()
+        cfg[cfg.BASE_SECTION][cfg.MIGRATOR_TARGETS] = ', '.join(targets)
+        return cfg
+
+    def test_apply_all_targets(self):
+        first = self.write_migration(9000, up=["proxy_db.execute_sql('CREATE TABLE shard_table (id INTEGER)')"])
+        second = self.write_migration(9001, dependencies=[first])
+        shards = [self.shard_url('shard_{}'.format(i)) for i in range(4)]
+        config = self.get_config(shards)
+        Executor(config).make_required(second)
+        # Одна из баз уже в актуальном состоянии
+        Executor(config.for_target(shards[0])).fake_apply_many([{'hash': first}, {'hash': second}])
+
+        results = FanOut(config, workers=2).apply()
+        self.assertEqual([x.status for x in results], [TargetResult.STATUS_OK] * 4)
+        self.assertEqual(results[0].applied, [])
+        self.assertEqual(results[1].applied, [first, second])
+        for shard in shards[1:]:
+            db = config.for_target(shard).get_db()
+            self.assertIn('shard_table', db.get_tables())
+
+    def test_failure_policy(self):
+        revision = self.write_migration(9100)
+        broken = 'sqlite:///{}'.format(os.path.join(self.dirpath, 'missing', 'broken.db'))
+        targets = [broken, self.shard_url('a'), self.shard_url('b')]
+        config = self.get_config(targets)
+
+        results = FanOut(config, workers=1).apply([revision])
+        self.assertEqual(
+            [x.status for x in results],
+            [TargetResult.STATUS_FAILED, TargetResult.STATUS_SKIPPED, TargetResult.STATUS_SKIPPED]
+        )
+        self.assertIsNotNone(results[0].error)
+
+        results = FanOut(config, workers=1, stop_on_failure=False).apply([revision])
+        self.assertEqual(
+            [x.status for x in results], [TargetResult.STATUS_FAILED, TargetResult.STATUS_OK, TargetResult.STATUS_OK]
+        )
+
+    def test_requires_database_state(self):
+        config = self.get_config([self.shard_url('a')])
+        config[config.BASE_SECTION][config.MIGRATOR_STATE_BACKEND] = 'fs'
+        with self.assertRaises(TargetError):
+            FanOut(config).apply([])
@@ -0,0 +1,554 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import datetime
+import decimal
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+import uuid
+
+import peewee
+import six
+
+from migrator.config import Config
+from migrator.container import (
+    COMPRESSION_GZIP, COMPRESSION_NONE, EXTENSIONS, ChunkStore, ChunkWriter, get_compressions
+)
+from migrator.executor import Executor
+from migrator.fixtures import FixtureLoader, FixtureTable
+from migrator.manifest import Manifest
+from migrator.pg_copy import CopyStream, decode_line, decode_value, encode_row
+from migrator.utils import PickleFallbackEncoder, RowCodec, TaggedEncoder, pickle_tagged_hook, tagged_hook
+from tests.test_migration_code import BaseTestCase
+from tests.utils import TestCliBase, PostrgesTestMixin
+
+
+class FixtureTestCase(BaseTestCase):
+    ROWS = 25
+
+    def setUp(self):
+        super(FixtureTestCase, self).setUp()
+        db = self.db
+
+        class Author(peewee.Model):
+            name = peewee.CharField(max_length=64)
+
+            class Meta:
+                database = db
+
+        class Book(peewee.Model):
+            author = peewee.ForeignKeyField(Author)
+            title = peewee.CharField(max_length=64)
+            published = peewee.DateTimeField(null=True)
+            price = peewee.DecimalField(null=True)
+
+            class Meta:
+                database = db
+
+        self.Author, self.Book = Author, Book
+        db.create_tables([Author, Book])
+        with db.atomic():
+            for i in range(self.ROWS):
+                author = Author.create(name='author {}'.format(i))
+                Book.create(
+                    author=author, title='book {}'.format(i), published=datetime.datetime(2017, 1, 1 + i % 28),
+                    price='{}.50'.format(i)
+                )
+
+    def tearDown(self):
+        for name in [x for x in sys.modules if x.startswith('migration_')]:
+            del sys.modules[name]
+        super(FixtureTestCase, self).tearDown()
+
+    def make_data_migration(self, migration_time, **kwargs):
+        loader = FixtureLoader(self.get_config(), **kwargs)
+        path = loader.make_data_migration('data', migration_time=migration_time)
+        return loader, Manifest.revision_by_file(os.path.basename(path))
+
+    def clear_tables(self):
+        with self.db.atomic():
+            self.Book.delete().execute()
+            self.Author.delete().execute()
+
+    def apply(self, revision):
+        executor = Executor(self.get_config())
+        executor.apply(executor.fetch_migration(revision))
+
+    def assertRestored(self):
+        self.assertEqual(self.Author.select().count(), self.ROWS)
+        self.assertEqual(self.Book.select().count(), self.ROWS)
+        book = self.Book.get(self.Book.title == 'book 3')
+        self.assertEqual(book.author.name, 'author 3')
+        self.assertEqual(book.published, datetime.datetime(2017, 1, 4))
+
+
+class StreamingDumpTest(FixtureTestCase):
+    def test_dump_and_load(self):
+        loader, revision = self.make_data_migration(3000, chunk_size=7, chunk_rows=10)
+        fixture_path = loader.get_fixture_path(revision)
+        with open(os.path.join(fixture_path, loader.MANIFEST_FILE)) as f:
+            tables = json.loads(f.read())['tables']
+        self.assertEqual({k: v['rows'] for k, v in tables.items()}, {'author': self.ROWS, 'book': self.ROWS})
+        self.assertEqual([x['rows'] for x in tables['book']['chunks']], [10, 10, 5])
+        self.assertTrue(os.path.exists(loader.store.get_path(tables['book']['chunks'][0]['sha256'], 'jsonl.gz')))
+        rows = [json.loads(line) for line in FixtureTable(tables['book'], store=loader.store).iter_lines()]
+        self.assertEqual([x['id'] for x in rows], list(range(1, self.ROWS + 1)))
+        self.assertEqual(rows[0]['author'], 1)
+        self.assertEqual(rows[0]['published'], '2017-01-01 00:00:00')
+        self.assertEqual(decimal.Decimal(rows[0]['price']), decimal.Decimal('0.50'))
+
+        self.clear_tables()
+        self.apply(revision)
+        self.assertRestored()
+
+
+class IncrementalDumpTest(FixtureTestCase):
+    def test_delta_chain(self):
+        config = self.get_config()
+        config[config.BASE_SECTION][config.MIGRATOR_FIXTURE_WATERMARKS] = 'book:published'
+        loader = FixtureLoader(config)
+        first = loader.make_data_migration('full', migration_time=1000)
+        first = Manifest.revision_by_file(os.path.basename(first))
+
+        author = self.Author.create(name='new author')
+        self.Book.create(author=author, title='new book', published=datetime.datetime(2018, 1, 1))
+        # Строка с тем же значением, что у отметки, записанная после выгрузки
+        self.Book.create(author=author, title='late book', published=datetime.datetime(2017, 1, self.ROWS))
+        self.Book.update(title='changed', published=datetime.datetime(2018, 1, 2)).where(self.Book.id == 1).execute()
+        second = loader.make_data_migration('delta', incremental=True, migration_time=2000)
+        second = Manifest.revision_by_file(os.path.basename(second))
+
+        manifest = loader.read_manifest(second)
+        self.assertEqual(manifest['base'], first)
+        self.assertEqual(manifest['watermarks']['author'], {'field': 'id', 'value': self.ROWS + 1})
+        self.assertEqual(manifest['watermarks']['book']['value'], datetime.datetime(2018, 1, 2))
+        fixture = loader.read_fixture(second)
+        self.assertEqual([x['name'] for x in fixture['author'].iter_rows(self.Author)], ['new author'])
+        self.assertEqual(
+            sorted(x['title'] for x in fixture['book'].iter_rows(self.Book)),
+            ['book {}'.format(self.ROWS - 1), 'changed', 'late book', 'new book']
+        )
+        self.assertEqual(Executor(config).fetch_migration(second)['dependencies'], [first])
+
+        self.clear_tables()
+        self.apply(first)
+        self.apply(second)
+        self.assertEqual(self.Author.select().count(), self.ROWS + 1)
+        self.assertEqual(self.Book.select().count(), self.ROWS + 2)
+        self.assertEqual(self.Book.get(self.Book.id == 1).title, 'changed')
+
+    def test_not_after_filtered_dump(self):
+        loader = FixtureLoader(self.get_config())
+        filtered = loader.make_data_migration('seed', migration_time=1100, samples={'book': 50})
+        self.assertTrue(loader.read_manifest(Manifest.revision_by_file(os.path.basename(filtered)))['filtered'])
+        # Отметки по всей таблице пропустили бы строки, не попавшие в выборку
+        six.assertRaisesRegex(
+            self, Exception, 'filtered or sampled', loader.make_data_migration, 'delta', incremental=True,
+            migration_time=1200
+        )
+        six.assertRaisesRegex(
+            self, Exception, 'filtered or sampled', loader.make_data_migration, 'delta', incremental=True,
+            migration_time=1300, filters={'book': 'id > 10'}
+        )
+
+
+class FilteredDumpTest(FixtureTestCase):
+    def test_filter_sample_and_parents(self):
+        loader = FixtureLoader(self.get_config())
+        path = loader.make_data_migration(
+            'seed', migration_time=3650, filters={'book': "title in ('book 3', 'book 7')"}, samples={'author': 10}
+        )
+        fixture = loader.read_fixture(Manifest.revision_by_file(os.path.basename(path)))
+        self.assertEqual(sorted(x['title'] for x in fixture['book'].iter_rows(self.Book)), ['book 3', 'book 7'])
+        # Каждый десятый автор и авторы выбранных книг
+        self.assertEqual(sorted(x['id'] for x in fixture['author'].iter_rows(self.Author)), [4, 8, 10, 20])
+
+    def test_unfiltered_parents_restricted(self):
+        loader = FixtureLoader(self.get_config())
+        path = loader.make_data_migration(
+            'seed', migration_time=3700, filters={'book': "title in ('book 3', 'book 7')"}
+        )
+        fixture = loader.read_fixture(Manifest.revision_by_file(os.path.basename(path)))
+        # Выгружаются только авторы выбранных книг
+        self.assertEqual(sorted(x['id'] for x in fixture['author'].iter_rows(self.Author)), [4, 8])
+
+    def test_unknown_model(self):
+        loader = FixtureLoader(self.get_config())
+        six.assertRaisesRegex(
+            self, Exception, 'Unknown models in filters: missing', loader.make_data_migration, 'seed',
+            migration_time=3660, filters={'missing': 'id = 1'}
+        )
+
+    def test_sample_percent(self):
+        loader = FixtureLoader(self.get_config())
+        for percent in (0, -5, 101):
+            six.assertRaisesRegex(self, Exception, 'Sample percent', loader.get_sample_condition, self.Author, percent)
+
+
+class StateTableTest(FixtureTestCase):
+    def get_config(self):
+        cfg = super(StateTableTest, self).get_config()
+        cfg[cfg.BASE_SECTION][cfg.MIGRATOR_STATE_BACKEND] = 'db'
+        return cfg
+
+    def test_history_not_dumped(self):
+        executor = Executor(self.get_config())
+        first = Manifest.revision_by_file(os.path.basename(
+            executor.make_migration(['import peewee'], [], migration_name='first', migration_time=3900)
+        ))
+        executor.apply(executor.fetch_migration(first))
+        loader, revision = self.make_data_migration(3901)
+        self.assertEqual(sorted(loader.read_manifest(revision)['tables']), ['author', 'book'])
+
+        executor = Executor(self.get_config())
+        executor.revert(executor.fetch_migration(first))
+        executor.apply(executor.fetch_migration(revision))
+        # Загрузка фикстуры не возвращает отмененную миграцию в историю
+        self.assertEqual(Executor(self.get_config()).get_applied(), [revision])
+
+
+class FastLoadTest(FixtureTestCase):
+    def test_indexes_and_session_restored(self):
+        self.db.execute_sql('CREATE INDEX book_title ON book (title)')
+        loader, revision = self.make_data_migration(3100, fast_load=True)
+        self.clear_tables()
+        indexes = []
+        model_preload = loader._model_preload
+
+        def model_preload_with_check(model_class):
+            indexes.append([x.name for x in loader.db.get_indexes(model_class._meta.db_table)])
+            self.assertEqual(loader.db.execute_sql('PRAGMA synchronous').fetchone()[0], 0)
+            model_preload(model_class)
+
+        loader._model_preload = model_preload_with_check
+        synchronous = loader.db.execute_sql('PRAGMA synchronous').fetchone()[0]
+        loader.load_data(revision, {'author': self.Author, 'book': self.Book})
+        self.assertRestored()
+        self.assertNotIn('book_title', indexes[1])
+        self.assertIn('book_title', [x.name for x in loader.db.get_indexes('book')])
+        self.assertEqual(loader.db.execute_sql('PRAGMA synchronous').fetchone()[0], synchronous)
+        self.assertEqual(loader.db.execute_sql('PRAGMA journal_mode').fetchone()[0], 'delete')
+
+    def test_load_error_not_masked(self):
+        self.db.execute_sql('CREATE INDEX book_title ON book (title)')
+        loader, revision = self.make_data_migration(3800, fast_load=True)
+        self.clear_tables()
+        drop_indexes, model_preload = loader.drop_indexes, loader._model_preload
+
+        def failing_preload(model_class):
+            if model_class is self.Book:
+                self.assertNotIn('book_title', [x.name for x in loader.db.get_indexes('book')])
+                raise ValueError(model_class.__name__)
+            model_preload(model_class)
+
+        # Ошибка создания одного индекса не подменяет ошибку загрузки и не мешает создать остальные
+        loader.drop_indexes = lambda model_class: (
+            ['CREATE INDEX broken ON missing (id)'] if model_class is self.Book else []
+        ) + drop_indexes(model_class)
+        loader._model_preload = failing_preload
+        with self.assertRaises(ValueError):
+            loader.load_data(revision, {'author': self.Author, 'book': self.Book})
+        self.assertIn('book_title', [x.name for x in loader.db.get_indexes('book')])
+
+
+class BulkLoadTest(FixtureTestCase):
+    ROWS = 450
+
+    def test_upsert(self):
+        loader, revision = self.make_data_migration(3200)
+        self.Book.delete().where(self.Book.id > 400).execute()
+        self.Author.update(name='changed').where(self.Author.id <= 10).execute()
+        self.assertGreater(self.ROWS * len(self.Book._meta.fields), loader.config.max_query_params)
+
+        self.apply(revision)
+        self.assertRestored()
+        self.assertEqual(self.Author.select().where(self.Author.name == 'changed').count(), 0)
+
+    def test_existing_pk_fallback(self):
+        loader = FixtureLoader(self.get_config())
+        rows = [{'id': 1, 'name': 'first'}, {'id': self.ROWS + 1, 'name': 'new'}]
+        loader._load_batch_by_existing(self.Author, rows)
+        self.assertEqual(self.Author.get(self.Author.id == 1).name, 'first')
+        self.assertEqual(self.Author.get(self.Author.id == self.ROWS + 1).name, 'new')
+
+
+class ChunkStorageTest(FixtureTestCase):
+    def test_unchanged_tables_share_chunks(self):
+        loader = FixtureLoader(self.get_config(), chunk_rows=10)
+        first = Manifest.revision_by_file(os.path.basename(loader.make_data_migration('first', migration_time=1000)))
+        self.Book.create(author=1, title='new book')
+        second = Manifest.revision_by_file(os.path.basename(loader.make_data_migration('second', migration_time=2000)))
+        first_tables = loader.read_manifest(first)['tables']
+        second_tables = loader.read_manifest(second)['tables']
+        self.assertEqual(first_tables['author']['chunks'], second_tables['author']['chunks'])
+        self.assertEqual(first_tables['book']['chunks'][:2], second_tables['book']['chunks'][:2])
+        self.assertEqual(len(list(loader.store.iter_files())), 3 + 4)
+
+        migrations_dir = loader.config.get_setting(Config.MIGRATOR_MIGRATIONS_DIR)
+        os.remove(os.path.join(migrations_dir, 'migration_{}.py'.format(first)))
+        removed = loader.gc()
+        self.assertEqual(removed[0], loader.get_fixture_path(first))
+        self.assertEqual(len(removed), 2)
+        self.clear_tables()
+        self.apply(second)
+        self.assertEqual(self.Book.select().count(), self.ROWS + 1)
+
+
+class ParallelLoadTest(FixtureTestCase):
+    def test_load_layers(self):
+        class Node(peewee.Model):
+            parent = peewee.ForeignKeyField('self', null=True)
+
+        class First(peewee.Model):
+            pass
+
+        class Second(peewee.Model):
+            first = peewee.ForeignKeyField(First)
+
+        peewee.ForeignKeyField(Second, null=True).add_to_class(First, 'second')
+        models = dict(Author=self.Author, Book=self.Book, Node=Node, First=First, Second=Second)
+        self.assertEqual(FixtureLoader.get_load_layers(models), [['Author', 'Node'], ['Book'], ['First', 'Second']])
+
+    def test_parallel_load(self):
+        loader, revision = self.make_data_migration(3300)
+        self.clear_tables()
+        # Для sqlite потоки отключены, здесь включаем их явно: таблицы одного слоя не пишутся одновременно
+        loader.workers = 2
+        loader.load_data(revision, {'author': self.Author, 'book': self.Book})
+        self.assertRestored()
+
+
+class ContainerTest(unittest.TestCase):
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.store = ChunkStore(self.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, compression, lines, chunk_rows=3):
+        writer = ChunkWriter(self.store, 'jsonl', compression, chunk_rows)
+        # Границы записи не совпадают с границами строк
+        data = ''.join(lines)
+        for i in range(0, len(data), 7):
+            writer.write(data[i:i + 7])
+        return writer.close()
+
+    def read(self, compression, chunks):
+        extension = 'jsonl{}'.format(EXTENSIONS[compression])
+        return [line for chunk in chunks for line in self.store.read_lines(chunk['sha256'], extension, compression)]
+
+    def test_round_trip(self):
+        lines = ['строка {}\n'.format(i) for i in range(8)]
+        for compression in get_compressions():
+            chunks = self.write(compression, lines)
+            self.assertEqual([x['rows'] for x in chunks], [3, 3, 2])
+            self.assertEqual(self.read(compression, chunks), lines)
+
+    def test_deduplication(self):
+        chunks = self.write(COMPRESSION_GZIP, ['{}\n'.format(i) for i in range(8)])
+        changed = self.write(COMPRESSION_GZIP, ['{}\n'.format(i) for i in range(7)] + ['new\n'])
+        self.assertEqual(chunks[:2], changed[:2])
+        self.assertNotEqual(chunks[2], changed[2])
+        self.assertEqual(len(list(self.store.iter_files())), 4)
+
+        removed = self.store.gc(set(x['sha256'] for x in changed))
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(self.read(COMPRESSION_GZIP, changed)[-1], 'new\n')
+
+    def test_gc_stale_temp_files(self):
+        self.write(COMPRESSION_NONE, ['{}\n'.format(i) for i in range(3)])
+        stale, fresh = self.store.get_temp_path(), self.store.get_temp_path()
+        for path in (stale, fresh):
+            with open(path, 'wb') as f:
+                f.write(b'partial')
+        past = time.time() - ChunkStore.TEMP_GRACE - 60
+        os.utime(stale, (past, past))
+
+        self.assertEqual(self.store.gc(set(x[0] for x in self.store.iter_files()), dry_run=True), [stale])
+        self.assertTrue(os.path.exists(stale))
+        self.assertEqual(self.store.gc(set(x[0] for x in self.store.iter_files())), [stale])
+        self.assertFalse(os.path.exists(stale))
+        self.assertTrue(os.path.exists(fresh))
+
+    def test_checksum(self):
+        chunks = self.write(COMPRESSION_NONE, ['{}\n'.format(i) for i in range(8)])
+        path = self.store.get_path(chunks[1]['sha256'], 'jsonl')
+        with open(path, 'r+b') as f:
+            f.write(b'9')
+        self.assertRaises(Exception, self.read, COMPRESSION_NONE, chunks)
+        # Строки измененной части не выдаются до проверки
+        lines = self.store.read_lines(chunks[1]['sha256'], 'jsonl', COMPRESSION_NONE)
+        self.assertRaises(Exception, next, lines)
+
+    def test_verified_memo(self):
+        chunks = self.write(COMPRESSION_NONE, ['{}\n'.format(i) for i in range(8)])
+        self.read(COMPRESSION_NONE, chunks)
+        self.store.save_verified()
+        store = ChunkStore(self.dirpath)
+        self.assertEqual(sorted(store.verified), sorted(x['sha256'] for x in chunks))
+        # Измененный файл проверяется заново
+        path = self.store.get_path(chunks[0]['sha256'], 'jsonl')
+        with open(path, 'ab') as f:
+            f.write(b'extra\n')
+        self.assertRaises(Exception, lambda: list(store.read_lines(chunks[0]['sha256'], 'jsonl', COMPRESSION_NONE)))
+
+
+class TaggedCodecTest(unittest.TestCase):
+    VALUES = [
+        datetime.datetime(2017, 5, 6, 7, 8, 9, 10), datetime.date(2017, 5, 6), datetime.time(7, 8, 9),
+        decimal.Decimal('10.25'), uuid.UUID('12345678123456781234567812345678'), b'\x00\xffbytes',
+    ]
+
+    def test_round_trip(self):
+        data = json.dumps(self.VALUES + [memoryview(b'view')], cls=TaggedEncoder)
+        self.assertNotIn('__pickled_object__', data)
+        self.assertEqual(json.loads(data, object_hook=tagged_hook), self.VALUES + [b'view'])
+
+    def test_pickle_is_opt_in(self):
+        value = {1, 2}
+        self.assertRaises(TypeError, json.dumps, value, cls=TaggedEncoder)
+        data = json.dumps(value, cls=PickleFallbackEncoder)
+        self.assertRaises(Exception, json.loads, data, object_hook=tagged_hook)
+        self.assertEqual(json.loads(data, object_hook=pickle_tagged_hook), value)
+
+    def test_row_codec(self):
+        class CodecModel(peewee.Model):
+            created = peewee.DateTimeField()
+            price = peewee.DecimalField()
+            key = peewee.UUIDField()
+            name = peewee.CharField()
+
+        row = {'id': 1, 'created': self.VALUES[0], 'price': self.VALUES[3], 'key': self.VALUES[4], 'name': 'x'}
+        codec = RowCodec(CodecModel)
+        encoded = json.loads(json.dumps(codec.encode(dict(row)), cls=TaggedEncoder))
+        self.assertEqual(encoded['created'], '2017-05-06 07:08:09.000010')
+        self.assertEqual(codec.decode(encoded), row)
+
+
+class CopyEncodingTest(unittest.TestCase):
+    def test_round_trip(self):
+        values = [
+            None, '', 'tab\there', 'line\nbreak\r', 'back\\slash \\N', True, False, 42, 1.5,
+            decimal.Decimal('10.25'), datetime.datetime(2017, 5, 6, 7, 8, 9), b'\x00\xffbytes',
+        ]
+        line = encode_row(values)
+        self.assertEqual(line.count('\n'), 1)
+        self.assertEqual(line.count('\t'), len(values) - 1)
+        decoded = decode_line(line)
+        self.assertEqual(decoded[:5], [None, '', 'tab\there', 'line\nbreak\r', 'back\\slash \\N'])
+        self.assertEqual(decoded[5:], ['t', 'f', '42', '1.5', '10.25', '2017-05-06 07:08:09', '\\x00ff6279746573'])
+
+        self.assertIs(decode_value(peewee.BooleanField(), decoded[6]), False)
+        self.assertEqual(decode_value(peewee.BlobField(), decoded[-1]), b'\x00\xffbytes')
+        self.assertEqual(decode_value(peewee.DecimalField(), decoded[9]), decimal.Decimal('10.25'))
+        self.assertEqual(decode_value(peewee.DateTimeField(), '2017-05-06 07:08:09'), datetime.datetime(2017, 5, 6, 7, 8, 9))
+
+    def test_stream(self):
+        stream = CopyStream(['first\n', 'second\n', 'third\n'])
+        self.assertEqual(stream.read(3), 'fir')
+        self.assertEqual(stream.readline(), 'st\n')
+        self.assertEqual(stream.read(), 'second\nthird\n')
+        self.assertEqual(stream.read(10), '')
+
+
+class CopyFormatLoadTest(FixtureTestCase):
+    def test_copy_opt_in(self):
+        config = self.get_config()
+        config[config.BASE_SECTION][config.MIGRATOR_DB_URL] = 'postgres://user@localhost/db'
+        self.assertFalse(FixtureLoader(config).use_copy)
+        config[config.BASE_SECTION][config.MIGRATOR_FIXTURE_COPY] = 'yes'
+        self.assertTrue(FixtureLoader(config).use_copy)
+
+    def test_load_copy_file_without_server(self):
+        loader, revision = self.make_data_migration(3400)
+        fixture_path = loader.get_fixture_path(revision)
+        manifest_path = os.path.join(fixture_path, loader.MANIFEST_FILE)
+        with open(manifest_path) as f:
+            tables = json.loads(f.read())['tables']
+        # Перевод выгрузки в формат COPY, как ее записал бы dump_model_copy
+        for model_name, model_class in (('author', self.Author), ('book', self.Book)):
+            fields = model_class._meta.sorted_fields
+            table = FixtureTable(tables[model_name], store=loader.store)
+            writer = loader.get_writer(FixtureTable.FORMAT_COPY)
+            for row in table.iter_rows(model_class):
+                writer.write(encode_row(field.db_value(row[field.name]) for field in fields))
+            chunks = writer.close()
+            tables[model_name] = {
+                'rows': writer.rows, 'format': FixtureTable.FORMAT_COPY, 'columns': [field.name for field in fields],
+                'compression': loader.compression, 'chunks': chunks
+            }
+        with open(manifest_path, 'w') as f:
+            f.write(json.dumps({'tables': tables}))
+
+        self.clear_tables()
+        self.apply(revision)
+        self.assertRestored()
+
+
+class CopyPostgresTest(PostrgesTestMixin, TestCliBase):
+    def test_copy_dump_and_load(self):
+        if not self.database_config_exists:
+            self.skipTest('No {} config'.format(self.DB_TYPE))
+            return
+        db = self.db
+
+        class CopyTestTable(peewee.Model):
+            name = peewee.CharField(max_length=64, null=True)
+            payload = peewee.BlobField(null=True)
+            flag = peewee.BooleanField(default=False)
+
+            class Meta:
+                database = db
+
+        CopyTestTable.create_table()
+        CopyTestTable.insert_many([
+            {'name': 'row\t{}'.format(i) if i % 3 else None, 'payload': b'\x00\x01', 'flag': bool(i % 2)}
+            for i in range(100)
+        ]).execute()
+        config = Config()
+        config.load(self.config_path)
+        loader = FixtureLoader(config, use_copy=True)
+        path = loader.make_data_migration('copy', dump_format=FixtureTable.FORMAT_COPY, migration_time=3500)
+        revision = Manifest.revision_by_file(os.path.basename(path))
+        fixture = loader.read_fixture(revision)
+        self.assertEqual(fixture['copytesttable'].format, FixtureTable.FORMAT_COPY)
+        expected = list(CopyTestTable.select().order_by(CopyTestTable.id).tuples())
+
+        CopyTestTable.delete().where(CopyTestTable.id > 50).execute()
+        CopyTestTable.update(name='changed').execute()
+        with loader.db.atomic():
+            loader.load_table(CopyTestTable, fixture['copytesttable'])
+        self.assertEqual(
+            [(x[0], x[1], bytes(x[2]), x[3]) for x in CopyTestTable.select().order_by(CopyTestTable.id).tuples()],
+            [(x[0], x[1], bytes(x[2]), x[3]) for x in expected]
+        )
+
+
+class ParallelDumpPostgresTest(PostrgesTestMixin, TestCliBase):
+    def test_snapshot_dump(self):
+        if not self.database_config_exists:
+            self.skipTest('No {} config'.format(self.DB_TYPE))
+            return
+        db = self.db
+        model_classes = []
+        for i in range(4):
+            model_class = type(str('SnapshotTable{}'.format(i)), (peewee.Model,), {
+                'name': peewee.CharField(max_length=64), 'Meta': type(str('Meta'), (), {'database': db})
+            })
+            model_class.create_table()
+            model_class.insert_many([{'name': 'row {}'.format(x)} for x in range(50)]).execute()
+            model_classes.append(model_class)
+        config = Config()
+        config.load(self.config_path)
+        loader = FixtureLoader(config, workers=3)
+        path = loader.make_data_migration('snapshot', migration_time=3600)
+        fixture = loader.read_fixture(Manifest.revision_by_file(os.path.basename(path)))
+        for model_class in model_classes:
+            self.assertEqual(fixture[model_class.__name__.lower()].meta['rows'], 50)
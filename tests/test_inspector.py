@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import codecs
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+from inspect import getmodule, ismethod
+
+import peewee
+
+from migrator.code_generator import CodeGenerator
+from migrator.db_inspector import Inspector, FieldDescriptor
+
+FIELD_CLASSES = [
+    (peewee.CharField, {'max_length': 100}), (peewee.IntegerField, {'null': True}), (peewee.TextField, {}),
+    (peewee.DateTimeField, {'index': True}), (peewee.DecimalField, {'max_digits': 12}), (peewee.BooleanField, {}),
+    (peewee.FloatField, {'default': 1.5}), (peewee.DateField, {'unique': True}), (peewee.BlobField, {}),
+    (peewee.UUIDField, {'null': True}),
+]
+
+
+def make_schema(models_count, fields_count):
+    db = peewee.SqliteDatabase(':memory:')
+    models = []
+    for i in range(models_count):
+        attrs = {'Meta': type(str('Meta'), (object,), {'database': db, 'db_table': 'table_{}'.format(i)})}
+        for j in range(fields_count):
+            field_class, kwargs = FIELD_CLASSES[(i + j) % len(FIELD_CLASSES)]
+            attrs['field_{}'.format(j)] = field_class(**kwargs)
+        if models:
+            attrs['parent'] = peewee.ForeignKeyField(models[-1], null=True)
+        models.append(type(str('Model{}'.format(i)), (peewee.Model,), attrs))
+    return models
+
+
+def reference_fields(inspector, sorted_fields):
+    """
+    Прежний сбор атрибутов поля через dir() и getattr для каждого поля
+    """
+    for field in sorted_fields:
+        field_path = '{}.{}'.format(getmodule(field.__class__).__name__, field.__class__.__name__)
+        field_params = {'index': field.index, 'unique': field.unique, 'null': field.null, 'initial_kwargs': {}}
+        default_value = inspector.get_field_default(field.default)
+        if default_value is not None:
+            field_params['default'] = default_value
+        for param in dir(field):
+            if param[0] == '_' or param in field_params or param in inspector.EXCLUDED_FIELDS:
+                continue
+            try:
+                param_obj = getattr(field, param)
+            except Exception:
+                param_obj = None
+            if ismethod(param_obj) or (param_obj is None and param in inspector.NOT_INCLUDE_IF_NULL):
+                continue
+            if param_obj is False and param in inspector.NOT_INCLUDE_IF_FALSE:
+                continue
+            field_params['initial_kwargs'][param] = param_obj
+        db_column = field.db_column
+        if isinstance(field, peewee.ForeignKeyField):
+            field_params['initial_kwargs']['rel_model'] = field.rel_model.__name__
+            db_column = field.name if field.db_column == '{}_id'.format(field.name) else field.db_column
+            field_params['initial_kwargs'].pop('to_field', None)
+        yield {'name': field.name, 'column': db_column, 'path': field_path, 'params': field_params}
+
+
+class InspectorTest(unittest.TestCase):
+
+    def test_same_as_reference(self):
+        models = make_schema(20, 12)
+        inspector = Inspector()
+        actual = [inspector.inspect_model(model) for model in models]
+        expected = [
+            (model.__name__, model._meta.db_table, list(reference_fields(inspector, model._meta.sorted_fields)))
+            for model in models
+        ]
+        self.assertEqual(CodeGenerator(actual).clses_json(), CodeGenerator(expected).clses_json())
+        for (_, _, fields), (_, _, expected_fields) in zip(actual, expected):
+            for field, expected_field in zip(fields, expected_fields):
+                self.assertEqual(
+                    set(field['params'].get('initial_kwargs', {})), set(expected_field['params']['initial_kwargs'])
+                )
+        # Планы вычисляются по одному на класс поля
+        self.assertEqual(len(inspector._field_plans), len(FIELD_CLASSES) + 2)
+
+    def test_descriptor_mapping(self):
+        class Message(peewee.Model):
+            text = peewee.CharField(null=True, max_length=10)
+
+        field = list(Inspector().collect_fields([Message.text]))[0]
+        self.assertIsInstance(field, FieldDescriptor)
+        self.assertFalse(hasattr(field, '__dict__'))
+        self.assertEqual(field['path'], 'peewee.CharField')
+        self.assertTrue(field['params']['null'])
+        self.assertIsNone(field['params'].get('default'))
+        self.assertNotIn('default', field['params'])
+        self.assertEqual(field['params']['initial_kwargs']['max_length'], 10)
+        self.assertEqual(sorted(field), ['column', 'name', 'params', 'path'])
+        with self.assertRaises(KeyError):
+            field['keys']
+
+    @unittest.skipUnless(os.environ.get('MIGRATOR_BENCHMARK'), 'Set MIGRATOR_BENCHMARK to run benchmarks')
+    def test_benchmark(self):
+        models = make_schema(800, 20)
+        inspector = Inspector()
+        started = time.time()
+        for model in models:
+            inspector.inspect_model(model)
+        elapsed = time.time() - started
+
+        started = time.time()
+        for model in models:
+            list(reference_fields(inspector, model._meta.sorted_fields))
+        reference_elapsed = time.time() - started
+        # 16000 полей: план по классам заметно быстрее dir() для каждого поля
+        self.assertLess(elapsed, reference_elapsed)
+
+
+class InspectionCacheTest(unittest.TestCase):
+    MODELS_CODE = """# -*- coding: utf-8 -*-
+import peewee
+
+LOADED = object()
+
+
+class Message(peewee.Model):
+    text = peewee.TextField()
+{extra}
+"""
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.module_name = 'inspected_models_{}'.format(random.randint(1000, 9999))
+        self.write_models('')
+        sys.path.insert(0, self.dirpath)
+
+    def tearDown(self):
+        sys.path.remove(self.dirpath)
+        sys.modules.pop(self.module_name, None)
+        shutil.rmtree(self.dirpath)
+
+    def write_models(self, extra):
+        path = os.path.join(self.dirpath, '{}.py'.format(self.module_name))
+        with codecs.open(path, 'w', 'utf-8') as f:
+            f.write(self.MODELS_CODE.format(extra=extra))
+        # Время изменения гарантированно другое
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+    def inspect(self):
+        return list(Inspector(models_path=[self.module_name]).inspect_models())
+
+    def test_unchanged_module_is_not_reloaded(self):
+        first = self.inspect()
+        loaded = sys.modules[self.module_name].LOADED
+        second = self.inspect()
+        self.assertIs(sys.modules[self.module_name].LOADED, loaded)
+        self.assertIs(second[0], first[0])
+
+        self.write_models('    author = peewee.CharField()')
+        third = self.inspect()
+        self.assertIsNot(sys.modules[self.module_name].LOADED, loaded)
+        self.assertEqual([field['name'] for field in third[0][2]], ['id', 'text', 'author'])
+
+    def test_excluded_models(self):
+        self.assertEqual(len(self.inspect()), 1)
+        inspector = Inspector(models_path=[self.module_name], excluded_models=['Message'])
+        self.assertEqual(list(inspector.inspect_models()), [])
@@ -3,6 +3,7 @@
 from __future__ import unicode_literals, absolute_import
 
 import codecs
+import importlib
 import os
 import random
 import shutil
@@ -66,11 +67,25 @@ class BaseTestCase(unittest.TestCase):
         })
         return cfg
 
+    def write_models(self, code_list):
+        cb = CodeGenerator.Builder()
+        for code in code_list:
+            if code == '<tab>':
+                cb.tab()
+            elif code == '<un_tab>':
+                cb.un_tab()
+            else:
+                cb.write_line(code)
+        with codecs.open('{}.py'.format(os.path.join(self.project_dir, self.MODELS_FILE_NAME)), 'w', 'utf-8') as f:
+            f.write(PY_FILE_TEMPLATE.format(code=cb.code))
+
 
 class MigrationCodeTest(BaseTestCase):
 
     def assertValidMigration(self, path):
         migration_name = os.path.basename(path).rsplit('.py', 1)[0]
+        if hasattr(importlib, 'invalidate_caches'):
+            importlib.invalidate_caches()
         try:
             __import__('{}.{}'.format(self.MIGRATIONS_DIR_NAME, migration_name), fromlist=['*'])
         except ImportError:
@@ -82,18 +97,6 @@ class MigrationCodeTest(BaseTestCase):
         with codecs.open(migration_path, 'r', 'utf-8') as f:
             return f.read()
 
-    def write_models(self, code_list):
-        cb = CodeGenerator.Builder()
-        for code in code_list:
-            if code == '<tab>':
-                cb.tab()
-            elif code == '<un_tab>':
-                cb.un_tab()
-            else:
-                cb.write_line(code)
-        with codecs.open('{}.py'.format(os.path.join(self.project_dir, self.MODELS_FILE_NAME)), 'w', 'utf-8') as f:
-            f.write(PY_FILE_TEMPLATE.format(code=cb.code))
-
     def test_database_no_table(self):
         self.write_models([
             'class Message(peewee.Model):',
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals, absolute_import
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import peewee
+from playhouse.reflection import Introspector
+
+from migrator.code_generator import CodeGenerator
+from migrator.db_inspector import Inspector
+from migrator.reflection import SchemaReflector, schema_fingerprint
+
+
+class ReflectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.db = peewee.SqliteDatabase(os.path.join(self.dirpath, 'test.db'))
+        self.db.connect()
+        self.db.execute_sql('CREATE TABLE author (id INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL)')
+        self.db.execute_sql('CREATE UNIQUE INDEX author_name ON author (name)')
+        self.db.execute_sql(
+            'CREATE TABLE book (id INTEGER PRIMARY KEY, title TEXT, author_id INTEGER NOT NULL REFERENCES author (id))'
+        )
+        self.db.execute_sql('CREATE TABLE other (id INTEGER PRIMARY KEY, value REAL)')
+        self.cache_path = os.path.join(self.dirpath, '.reflection.json')
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.dirpath)
+
+    def test_scoped_tables(self):
+        models = SchemaReflector(self.db).generate_models(table_names=['book'])
+        # author попадает по внешнему ключу, other - нет
+        self.assertEqual(sorted(models), ['author', 'book'])
+        self.assertIs(models['book'].author.rel_model, models['author'])
+
+    def test_same_as_introspector(self):
+        expected = [
+            Inspector().inspect_model(model) for model in Introspector.from_database(self.db).generate_models().values()
+        ]
+        actual = list(Inspector().inspect_database(self.db, cache_path=self.cache_path))
+        self.assertEqual(
+            sorted(CodeGenerator(actual).clses_json(), key=lambda x: x['name']),
+            sorted(CodeGenerator(expected).clses_json(), key=lambda x: x['name'])
+        )
+        # Повторное чтение из кеша дает то же описание
+        cached = list(Inspector().inspect_database(self.db, cache_path=self.cache_path))
+        self.assertEqual(
+            sorted(CodeGenerator(cached).clses_json(), key=lambda x: x['name']),
+            sorted(CodeGenerator(expected).clses_json(), key=lambda x: x['name'])
+        )
+
+    def test_cache(self):
+        reflector = SchemaReflector(self.db, cache_path=self.cache_path)
+        reflector.generate_models(table_names=['book'])
+        self.assertTrue(os.path.exists(self.cache_path))
+
+        fetched = []
+        fetch = reflector.fetch
+        reflector.fetch = lambda table_names=None: fetched.append(table_names) or fetch(table_names)
+        models = reflector.generate_models(table_names=['book'])
+        self.assertEqual(sorted(models), ['author', 'book'])
+        self.assertEqual(fetched, [])
+
+        # Изменение схемы меняет отпечаток, кеш перечитывается
+        fingerprint = schema_fingerprint(self.db)
+        self.db.execute_sql('ALTER TABLE book ADD COLUMN pages INTEGER')
+        self.assertNotEqual(schema_fingerprint(self.db), fingerprint)
+        models = reflector.generate_models(table_names=['book'])
+        self.assertEqual(fetched, [['book']])
+        self.assertIn('pages', models['book']._meta.fields)
+
+    def test_missing_targets_fetched_at_once(self):
+        self.db.execute_sql('CREATE TABLE tag (id INTEGER PRIMARY KEY)')
+        self.db.execute_sql(
+            'CREATE TABLE note (id INTEGER PRIMARY KEY, author_id INTEGER REFERENCES author (id), '
+            'tag_id INTEGER REFERENCES tag (id))'
+        )
+        reflector = SchemaReflector(self.db, cache_path=self.cache_path)
+        reflector.generate_models(table_names=['note'])
+        # Кеш без таблиц, на которые ссылается note
+        cache = reflector.read_cache()
+        del cache['tables']['author'], cache['tables']['tag']
+        reflector.write_cache(cache)
+
+        fetched = []
+        fetch = reflector.fetch
+        reflector.fetch = lambda table_names=None: fetched.append(table_names) or fetch(table_names)
+        models = reflector.generate_models(table_names=['note'])
+        self.assertEqual(sorted(models), ['author', 'note', 'tag'])
+        self.assertEqual(fetched, [['author', 'tag']])